@@ -0,0 +1,95 @@
+"""Message storage layout benchmark.
+
+Compares the per-document message layout with the bucket layout
+(MESSAGE_STORAGE="bucket") on write throughput and conversation history
+read latency, using the server's own storage and get_conversation code paths.
+
+Runs against MONGO_URL in a throwaway "<DB_NAME>_benchmark" database.
+
+Usage:
+    python message_storage_benchmark.py --conversations 50 --messages 200
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+import server
+from server import Message, get_conversation_id
+
+
+async def write_messages(layout: str, pairs, messages_per_conversation: int, concurrency: int) -> float:
+    async def send(sender_id, receiver_id, i):
+        message = Message(
+            conversation_id=get_conversation_id(sender_id, receiver_id),
+            sender_id=sender_id,
+            receiver_id=receiver_id,
+            content=f"benchmark message {i}"
+        )
+        if layout == "bucket":
+            await server.append_bucket_message(message)
+        else:
+            await server.db.messages.insert_one(message.dict())
+
+    jobs = [
+        (a, b) if i % 2 == 0 else (b, a)
+        for i in range(messages_per_conversation)
+        for a, b in pairs
+    ]
+    start = time.perf_counter()
+    for offset in range(0, len(jobs), concurrency):
+        await asyncio.gather(*[
+            send(sender_id, receiver_id, offset + i)
+            for i, (sender_id, receiver_id) in enumerate(jobs[offset:offset + concurrency])
+        ])
+    return len(jobs) / (time.perf_counter() - start)
+
+
+async def read_history(pairs, page_size: int):
+    latest_page = []
+    full_history = []
+    for a, b in pairs:
+        start = time.perf_counter()
+        page = await server.get_conversation(b, before=None, after=None, limit=page_size, current_user={"id": a})
+        latest_page.append(time.perf_counter() - start)
+
+        while page:
+            page = await server.get_conversation(b, before=page[0].id, after=None, limit=page_size, current_user={"id": a})
+        full_history.append(time.perf_counter() - start)
+    return latest_page, full_history
+
+
+async def run_benchmark(conversations: int, messages: int, page_size: int, concurrency: int):
+    benchmark_db = f"{server.db.name}_benchmark"
+    await server.client.drop_database(benchmark_db)
+    server.db = server.client[benchmark_db]
+    await server.create_indexes()
+
+    pairs = [(f"bench-a-{i}", f"bench-b-{i}") for i in range(conversations)]
+    print(f"conversations={conversations} messages/conversation={messages} page={page_size}")
+
+    try:
+        for layout in ("document", "bucket"):
+            server.MESSAGE_STORAGE = layout
+            throughput = await write_messages(layout, pairs, messages, concurrency)
+            latest_page, full_history = await read_history(pairs, page_size)
+            print(f"  {layout}:")
+            print(f"    writes:          {throughput:,.0f} messages/s")
+            print(f"    latest page:     median {statistics.median(latest_page) * 1000:.2f}ms")
+            print(f"    full history:    median {statistics.median(full_history) * 1000:.2f}ms")
+    finally:
+        await server.client.drop_database(benchmark_db)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Message storage layout benchmark")
+    parser.add_argument("--conversations", type=int, default=50)
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--page-size", type=int, default=50)
+    parser.add_argument("--concurrency", type=int, default=20)
+    args = parser.parse_args()
+    asyncio.run(run_benchmark(args.conversations, args.messages, args.page_size, args.concurrency))
+
+
+if __name__ == "__main__":
+    main()
@@ -2,21 +2,35 @@ from fastapi import FastAPI, APIRouter, HTTPException, Depends, status, Request,
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import ReturnDocument, UpdateMany, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
 from dotenv import load_dotenv
 import os
 import logging
 from pathlib import Path
 from pydantic import BaseModel, Field, EmailStr
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Set
 import uuid
-from datetime import datetime, timezone, timedelta
+import time
+import math
+import functools
+import importlib.util
+from collections import OrderedDict
+from datetime import date, datetime, timezone, timedelta
 import jwt
 from passlib.context import CryptContext
 import razorpay
 import json
+import asyncio
 import socketio
-from fastapi.responses import JSONResponse
+import numpy as np
+import pandas as pd
+from socketio.async_pubsub_manager import AsyncPubSubManager
+from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi.encoders import jsonable_encoder
 import re
+import csv
+import io
 
 # Load environment variables
 ROOT_DIR = Path(__file__).parent
@@ -39,7 +53,84 @@ razorpay_client = razorpay.Client(auth=(
 ))
 
 # Socket.IO setup
-sio = socketio.AsyncServer(cors_allowed_origins="*")
+PRESENCE_SYNC_EVENT = '__presence_sync__'
+PRESENCE_SYNC_ROOM = '__presence_sync__'
+USER_ROLE_INVALIDATE_EVENT = '__user_role_invalidate__'
+
+class PresenceSyncMixin:
+    """Intercept presence snapshots and role cache invalidations published by other
+    workers instead of emitting them to clients"""
+    
+    async def _handle_emit(self, message):
+        if message.get('event') == PRESENCE_SYNC_EVENT:
+            snapshot = message['data'][0]
+            presence.apply_sync(snapshot['host_id'], snapshot['users'])
+            return
+        if message.get('event') == USER_ROLE_INVALIDATE_EVENT:
+            for user_id in message['data'][0]:
+                user_role_cache.invalidate(user_id)
+            return
+        await super()._handle_emit(message)
+
+class PresenceRedisManager(PresenceSyncMixin, socketio.AsyncRedisManager):
+    pass
+
+class PresenceAioPikaManager(PresenceSyncMixin, socketio.AsyncAioPikaManager):
+    pass
+
+class LocalPubSubManager(PresenceSyncMixin, AsyncPubSubManager):
+    """Socket.IO pub/sub manager backed by an in-process broker.
+    
+    Servers created in the same process share rooms and emits through it exactly
+    as separate workers would through Redis or RabbitMQ, which makes multi-worker
+    behaviour testable without external services.
+    """
+    name = 'localpubsub'
+    channels: Dict[str, List[asyncio.Queue]] = {}
+    
+    def __init__(self, channel='socketio', write_only=False, logger=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+        self.queue = asyncio.Queue()
+        if not write_only:
+            self.channels.setdefault(channel, []).append(self.queue)
+    
+    async def _publish(self, data):
+        message = self.json.dumps(data)  # serialise like a real broker would
+        for queue in self.channels.get(self.channel, []):
+            queue.put_nowait(message)
+    
+    async def _listen(self):
+        while True:
+            yield await self.queue.get()
+
+def create_socketio_manager(url: Optional[str]):
+    """Build the Socket.IO client manager for SOCKETIO_MESSAGE_QUEUE.
+    
+    No URL keeps rooms in this process (single worker only); "local" uses the
+    in-process broker; redis:// and amqp:// URLs share rooms across workers and nodes.
+    """
+    if not url:
+        return None
+    if url == "local":
+        return LocalPubSubManager()
+    
+    scheme = url.split("://", 1)[0]
+    for schemes, package, manager_class in (
+        (("redis", "rediss"), "redis", PresenceRedisManager),
+        (("amqp", "amqps"), "aio_pika", PresenceAioPikaManager),
+    ):
+        if scheme in schemes:
+            # socketio only imports the broker client once it connects, fail at startup instead
+            if importlib.util.find_spec(package) is None:
+                raise RuntimeError(f"SOCKETIO_MESSAGE_QUEUE {scheme}:// requires the {package} package")
+            return manager_class(url)
+    raise ValueError(f"Unsupported SOCKETIO_MESSAGE_QUEUE scheme: {scheme}")
+
+sio = socketio.AsyncServer(
+    async_mode="asgi",
+    cors_allowed_origins="*",
+    client_manager=create_socketio_manager(os.environ.get('SOCKETIO_MESSAGE_QUEUE'))
+)
 
 # FastAPI app
 app = FastAPI(title="UniNest API", description="Student & Library Platform")
@@ -52,6 +143,10 @@ def validate_indian_phone(phone: str) -> bool:
     return bool(re.match(pattern, phone))
 
 # Utility functions
+def user_search_fields(name: str, location: str) -> dict:
+    """Lowercased copies of the fields the student directory prefix-searches"""
+    return {"name_lower": name.strip().lower(), "location_lower": location.strip().lower()}
+
 def hash_password(password: str) -> str:
     return pwd_context.hash(password)
 
@@ -70,7 +165,7 @@ def decode_jwt_token(token: str) -> dict:
         return payload
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Token expired")
-    except jwt.JWTError:
+    except jwt.InvalidTokenError:
         raise HTTPException(status_code=401, detail="Invalid token")
 
 async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(security)):
@@ -85,12 +180,195 @@ async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(s
         raise HTTPException(status_code=401, detail="User not found")
     return user
 
+class UserRoleCache:
+    """In-process LRU cache of user id -> role/is_active, with a TTL.
+    
+    Entries must be invalidated through invalidate_user_roles when a user's role or
+    status changes, which also tells the other workers over the message queue.
+    """
+    
+    def __init__(self, ttl: float, max_size: int):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries: "OrderedDict[str, tuple]" = OrderedDict()
+    
+    def _get_cached(self, user_id: str) -> Optional[dict]:
+        entry = self.entries.get(user_id)
+        if entry is None:
+            return None
+        expires_at, user = entry
+        if expires_at < time.monotonic():
+            del self.entries[user_id]
+            return None
+        self.entries.move_to_end(user_id)
+        return user
+    
+    def _store(self, user: dict):
+        self.entries[user["id"]] = (time.monotonic() + self.ttl, user)
+        self.entries.move_to_end(user["id"])
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+    
+    async def get_many(self, user_ids: List[str]) -> Dict[str, dict]:
+        """Return cached users by id, loading all misses with one query"""
+        found = {}
+        missing = []
+        for user_id in user_ids:
+            user = self._get_cached(user_id)
+            if user is None:
+                missing.append(user_id)
+            else:
+                found[user_id] = user
+        
+        if missing:
+            users = await db.users.find(
+                {"id": {"$in": missing}},
+                {"_id": 0, "id": 1, "role": 1, "is_active": 1}
+            ).to_list(len(missing))
+            for user in users:
+                self._store(user)
+                found[user["id"]] = user
+        
+        return found
+    
+    async def get(self, user_id: str) -> Optional[dict]:
+        return (await self.get_many([user_id])).get(user_id)
+    
+    def invalidate(self, user_id: str):
+        self.entries.pop(user_id, None)
+
+user_role_cache = UserRoleCache(
+    ttl=float(os.environ.get('USER_ROLE_CACHE_TTL', '300')),
+    max_size=int(os.environ.get('USER_ROLE_CACHE_SIZE', '10000'))
+)
+
+async def invalidate_user_roles(user_ids: List[str]):
+    """Drop users from the role cache on this worker and, through the message queue, on the others"""
+    for user_id in user_ids:
+        user_role_cache.invalidate(user_id)
+    if isinstance(sio.manager, AsyncPubSubManager):
+        # Sent to the sync room no client can join, workers intercept it before any emit
+        await sio.emit(USER_ROLE_INVALIDATE_EVENT, user_ids, room=PRESENCE_SYNC_ROOM)
+
+async def get_current_user_role(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Lightweight get_current_user returning only id/role/is_active from the role cache"""
+    payload = decode_jwt_token(credentials.credentials)
+    user_id = payload.get("user_id")
+    if not user_id:
+        raise HTTPException(status_code=401, detail="Invalid token")
+    
+    user = await user_role_cache.get(user_id)
+    if not user:
+        raise HTTPException(status_code=401, detail="User not found")
+    return user
+
 async def get_admin_user(current_user: dict = Depends(get_current_user)):
     """Ensure current user is an admin"""
     if current_user["role"] != "admin":
         raise HTTPException(status_code=403, detail="Admin access required")
     return current_user
 
+# Rate limiting: token bucket budgets as (tokens refilled per second, burst size),
+# overridable with RATE_LIMITS='{"messages": [1, 10]}'
+RATE_LIMIT_BUDGETS = {
+    "messages": (1.0, 20),
+    "posts": (0.2, 5),
+    "comments": (0.5, 10),
+    "likes": (2.0, 30),
+    "socket_events": (10.0, 50),
+    "socket_rooms": (1.0, 20),
+}
+RATE_LIMIT_BUDGETS.update({
+    name: (float(rate), int(burst))
+    for name, (rate, burst) in json.loads(os.environ.get('RATE_LIMITS', '{}')).items()
+})
+# "memory" limits per worker; "mongo" shares buckets across workers at one DB round trip per call
+RATE_LIMIT_STORE = os.environ.get('RATE_LIMIT_STORE', 'memory')
+
+class TokenBucketLimiter:
+    """Per-user token buckets with allowed/limited counters per budget.
+    
+    In-process buckets live in a bounded LRU; an evicted bucket starts full again.
+    """
+    
+    def __init__(self, budgets: Dict[str, tuple], store: str = "memory", max_size: int = 100000):
+        self.budgets = budgets
+        self.store = store
+        self.max_size = max_size
+        self.buckets: "OrderedDict[str, tuple]" = OrderedDict()
+        self.metrics = {name: {"allowed": 0, "limited": 0} for name in budgets}
+    
+    def _take_local(self, key: str, rate: float, burst: int) -> tuple:
+        now = time.monotonic()
+        tokens, updated_at = self.buckets.get(key, (burst, now))
+        tokens = min(burst, tokens + (now - updated_at) * rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        self.buckets[key] = (tokens, now)
+        self.buckets.move_to_end(key)
+        while len(self.buckets) > self.max_size:
+            self.buckets.popitem(last=False)
+        return allowed, tokens
+    
+    async def _take_shared(self, key: str, rate: float, burst: int) -> tuple:
+        now = datetime.now(timezone.utc)
+        elapsed = {"$divide": [{"$subtract": [now, {"$ifNull": ["$updated_at", now]}]}, 1000]}
+        # Refill and take in one atomic pipeline update
+        bucket = await db.rate_limits.find_one_and_update(
+            {"_id": key},
+            [
+                {"$set": {"tokens": {"$min": [burst, {"$add": [{"$ifNull": ["$tokens", burst]}, {"$multiply": [elapsed, rate]}]}]}}},
+                {"$set": {
+                    "allowed": {"$gte": ["$tokens", 1]},
+                    "tokens": {"$cond": [{"$gte": ["$tokens", 1]}, {"$subtract": ["$tokens", 1]}, "$tokens"]},
+                    "updated_at": now,
+                    "expires_at": now + timedelta(seconds=burst / rate)
+                }}
+            ],
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+        return bucket["allowed"], bucket["tokens"]
+    
+    async def check(self, budget: str, identity: str) -> float:
+        """Take a token from the identity's bucket; returns 0 if allowed, else seconds until the next token"""
+        rate, burst = self.budgets[budget]
+        key = f"{budget}:{identity}"
+        if self.store == "mongo":
+            allowed, tokens = await self._take_shared(key, rate, burst)
+        else:
+            allowed, tokens = self._take_local(key, rate, burst)
+        
+        self.metrics[budget]["allowed" if allowed else "limited"] += 1
+        return 0.0 if allowed else (1 - tokens) / rate
+    
+    def snapshot(self) -> dict:
+        return {
+            "store": self.store,
+            "budgets": {name: {"rate": rate, "burst": burst} for name, (rate, burst) in self.budgets.items()},
+            "metrics": self.metrics,
+            "tracked_buckets": len(self.buckets)
+        }
+
+rate_limiter = TokenBucketLimiter(RATE_LIMIT_BUDGETS, store=RATE_LIMIT_STORE)
+
+def rate_limit(budget: str):
+    """Route dependency rejecting the caller with 429 once their budget is spent.
+    
+    Only decodes the token, so abusive callers are turned away before any DB work.
+    """
+    async def dependency(credentials: HTTPAuthorizationCredentials = Depends(security)):
+        payload = decode_jwt_token(credentials.credentials)
+        retry_after = await rate_limiter.check(budget, payload.get("user_id"))
+        if retry_after:
+            raise HTTPException(
+                status_code=429,
+                detail="Too many requests",
+                headers={"Retry-After": str(math.ceil(retry_after))}
+            )
+    return dependency
+
 async def create_free_trial_subscription(library_id: str, user_id: str):
     """Create a 3-month free trial subscription for new library users"""
     start_date = datetime.now(timezone.utc)
@@ -337,32 +615,67 @@ class Post(BaseModel):
     content: str
     post_type: str
     creator_id: str
-    likes: List[str] = []  # user IDs who liked
-    comments: List[Dict[str, Any]] = []
+    location: str = ""  # creator's location, used to route the post to home feeds
+    likes_count: int = 0  # maintained alongside the post_likes collection
+    comments_count: int = 0  # maintained alongside the post_comments collection
+    comments: List[Dict[str, Any]] = []  # latest POST_COMMENT_PREVIEW_SIZE comments only
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+class PostLike(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    post_id: str
+    user_id: str
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 class CommentCreate(BaseModel):
     content: str
 
+class PostComment(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    post_id: str
+    content: str
+    user_id: str
+    user_name: str
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
+# Number of latest comments embedded in each post for the feed
+POST_COMMENT_PREVIEW_SIZE = 3
+
+# Home feed timelines: newest entries kept per location, and the posting rate
+# (posts per hour) above which a creator is served by fan-out-on-read instead
+FEED_TIMELINE_SIZE = 500
+FEED_HEAVY_POSTER_THRESHOLD = int(os.environ.get('FEED_HEAVY_POSTER_THRESHOLD', '20'))
+
+# Seconds over which new-post socket events are coalesced into one frame per room
+POST_EMIT_INTERVAL = float(os.environ.get('POST_EMIT_INTERVAL', '0.5'))
+
 class MessageCreate(BaseModel):
     receiver_id: str
     content: str
     message_type: str = "text"  # "text", "image", "file"
 
+class ConversationRead(BaseModel):
+    up_to_message_id: Optional[str] = None  # None marks the whole conversation as read
+
 class Message(BaseModel):
     id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    conversation_id: str = ""  # sorted participant pair, see get_conversation_id
     sender_id: str
     receiver_id: str
     content: str
     message_type: str = "text"
     is_read: bool = False
+    delivered: bool = False  # set once the receiver's client acks the pushed message
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
 class ChatRoom(BaseModel):
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))  # conversation_id for one-to-one chats
     participants: List[str]  # List of user IDs
     last_message: Optional[str] = ""
+    last_message_id: Optional[str] = ""
+    last_sender_id: Optional[str] = ""
     last_message_time: Optional[datetime] = None
+    unread_counts: Dict[str, int] = {}  # user ID -> unread messages for that participant
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
     updated_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
@@ -373,6 +686,7 @@ class AdminAction(BaseModel):
     action_type: str  # "user_delete", "user_suspend", "content_moderate", etc.
     target_id: str  # ID of affected user/content
     target_type: str  # "user", "book", "competition", etc.
+    target_ids: List[str] = Field(default_factory=list)  # Bulk actions: every affected id, target_id is "bulk"
     reason: Optional[str] = ""
     created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
 
@@ -380,6 +694,30 @@ class UserManagementAction(BaseModel):
     action: str  # "suspend", "activate", "delete"
     reason: Optional[str] = ""
 
+class BulkUserManagementAction(BaseModel):
+    user_ids: List[str]
+    action: str  # "suspend", "activate", "delete"
+    reason: Optional[str] = ""
+
+class BulkContentRemoval(BaseModel):
+    book_ids: List[str]
+    reason: Optional[str] = ""
+
+class DailyMetrics(BaseModel):
+    day: datetime  # midnight UTC
+    signups: Dict[str, int] = Field(default_factory=dict)  # by role
+    bookings: Dict[str, int] = Field(default_factory=dict)  # by library id
+    booked_seats: Dict[str, int] = Field(default_factory=dict)  # by library id
+    registrations: Dict[str, int] = Field(default_factory=dict)  # by payment status
+    revenue: Dict[str, int] = Field(default_factory=dict)  # paise, "subscriptions" and "competitions"
+
+class UserCleanupJob(BaseModel):
+    user_id: str
+    status: str = "pending"  # "pending", "running", "completed"
+    progress: Dict[str, int] = Field(default_factory=dict)  # rows handled per collection so far
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    completed_at: Optional[datetime] = None
+
 # Initialize Admin User
 async def initialize_admin():
     """Create admin user if it doesn't exist"""
@@ -401,12 +739,343 @@ async def initialize_admin():
         hashed_password = hash_password("5968474644j")
         admin_data = admin_user.dict()
         admin_data["password"] = hashed_password
+        admin_data.update(user_search_fields(admin_user.name, admin_user.location))
         
         await db.users.insert_one(admin_data)
         print(f"✅ Admin user created: {admin_email}")
     else:
         print(f"✅ Admin user already exists: {admin_email}")
 
+async def create_indexes():
+    """Create the indexes the hot query paths rely on"""
+    # One like per user per post; also makes concurrent like toggles safe
+    await db.post_likes.create_index([("post_id", 1), ("user_id", 1)], unique=True)
+    await db.post_comments.create_index([("post_id", 1), ("created_at", -1)])
+    await db.posts.create_index("id", unique=True)
+    await db.posts.create_index([("created_at", -1)])
+    await db.books.create_index([("created_at", -1)])
+    await db.books.create_index([("seller_id", 1), ("created_at", -1)])
+    await db.posts.create_index([("creator_id", 1), ("created_at", -1)])
+    await db.feed_timelines.create_index("key", unique=True)
+    await db.messages.create_index("id", unique=True)
+    await db.messages.create_index([("receiver_id", 1), ("created_at", 1), ("id", 1)])
+    # Includes id so the (created_at, id) conversation order comes straight from the index
+    await db.messages.create_index([("conversation_id", 1), ("created_at", 1), ("id", 1)])
+    for superseded in ("conversation_id_1_created_at_1", "receiver_id_1_created_at_1"):
+        try:
+            await db.messages.drop_index(superseded)
+        except OperationFailure:
+            pass  # Already dropped
+    await db.chat_rooms.create_index("id", unique=True)
+    await db.chat_rooms.create_index([("participants", 1), ("last_message_time", -1)])
+    await db.users.create_index("id", unique=True)
+    await db.users.create_index([("role", 1), ("name_lower", 1), ("id", 1)])
+    await db.users.create_index([("role", 1), ("location_lower", 1), ("id", 1)])
+    await db.messages_archive.create_index([("conversation_id", 1), ("month", -1), ("seq", -1)], unique=True)
+    await db.messages_archive.create_index([("conversation_id", 1), ("first_at", -1)])
+    await db.messages_archive.create_index([("conversation_id", 1), ("last_at", -1)])
+    await db.messages_archive.create_index("messages.id")
+    await db.message_buckets.create_index([("conversation_id", 1), ("seq", -1)], unique=True)
+    await db.message_buckets.create_index([("conversation_id", 1), ("first_at", -1)])
+    await db.message_buckets.create_index([("conversation_id", 1), ("last_at", -1)])
+    await db.message_buckets.create_index([("participants", 1), ("last_at", -1)])
+    await db.message_buckets.create_index("messages.id")
+    await db.rate_limits.create_index("expires_at", expireAfterSeconds=0)
+    await db.library_analytics.create_index("library_id", unique=True)
+    await db.ledger.create_index("payment_id", unique=True)
+    await db.ledger.create_index([("created_at", -1)])
+    await db.ledger.create_index([("entry_type", 1), ("created_at", -1)])
+    await db.ledger.create_index("competition_id")
+    await db.ledger_daily.create_index("day", unique=True)
+    await db.user_cleanup_jobs.create_index("user_id", unique=True)
+    await db.user_cleanup_jobs.create_index([("status", 1), ("created_at", 1)])
+    # Makes audit retries idempotent: re-inserting an entry that was already written is a duplicate key
+    await db.admin_actions.create_index("id", unique=True)
+    await db.admin_actions.create_index([("created_at", -1)])
+    await db.admin_actions.create_index([("action_type", 1), ("created_at", -1)])
+    await db.admin_actions.create_index([("target_type", 1), ("created_at", -1)])
+
+async def migrate_archive_buckets():
+    """Number the monthly archive buckets written before they were capped"""
+    await db.messages_archive.update_many(
+        {"seq": {"$exists": False}},
+        [{"$set": {"seq": 0, "count": {"$size": "$messages"}}}]
+    )
+    try:
+        await db.messages_archive.drop_index("conversation_id_1_month_-1")
+    except OperationFailure:
+        pass  # Already dropped
+
+async def migrate_message_buckets():
+    """Number the conversation buckets written before they were numbered, oldest first"""
+    unnumbered = db.message_buckets.find({"seq": {"$exists": False}}, {"conversation_id": 1}).sort(
+        [("conversation_id", 1), ("first_at", 1)]
+    )
+    conversation_id, seq = None, 0
+    async for bucket in unnumbered:
+        if bucket["conversation_id"] != conversation_id:
+            conversation_id, seq = bucket["conversation_id"], 0
+        await db.message_buckets.update_one({"_id": bucket["_id"]}, {"$set": {"seq": seq}})
+        seq += 1
+
+# Identifies this worker's job leases, so it only renews or releases its own
+JOB_LOCK_OWNER = str(uuid.uuid4())
+
+async def acquire_job_lock(name: str, lease: timedelta) -> bool:
+    """Take a time-limited lease so a periodic job runs on one worker at a time"""
+    now = datetime.now(timezone.utc)
+    try:
+        await db.job_locks.update_one(
+            {"_id": name, "expires_at": {"$lt": now}},
+            {"$set": {"expires_at": now + lease, "acquired_at": now, "owner": JOB_LOCK_OWNER}},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        return False  # Lease held by another worker
+    return True
+
+async def hold_job_lock(name: str, lease: timedelta):
+    """Keep extending a lease while the job holding it runs"""
+    while True:
+        await asyncio.sleep(lease.total_seconds() / 3)
+        await db.job_locks.update_one(
+            {"_id": name, "owner": JOB_LOCK_OWNER},
+            {"$set": {"expires_at": datetime.now(timezone.utc) + lease}}
+        )
+
+async def release_job_lock(name: str, until: Optional[datetime] = None):
+    """Give up a lease held by this worker, or with until, hold it no later than that"""
+    if until is None:
+        await db.job_locks.delete_one({"_id": name, "owner": JOB_LOCK_OWNER})
+    else:
+        await db.job_locks.update_one({"_id": name, "owner": JOB_LOCK_OWNER}, {"$set": {"expires_at": until}})
+
+# Audit entries are buffered and written with one insert_many once AUDIT_FLUSH_SIZE are
+# pending or AUDIT_FLUSH_INTERVAL seconds after the first one; buffered entries are
+# flushed on shutdown but lost on a crash, AUDIT_DURABILITY="sync" writes them inline
+AUDIT_FLUSH_SIZE = int(os.environ.get('AUDIT_FLUSH_SIZE', '100'))
+AUDIT_FLUSH_INTERVAL = float(os.environ.get('AUDIT_FLUSH_INTERVAL', '2'))
+AUDIT_DURABILITY = os.environ.get('AUDIT_DURABILITY', 'buffered')
+
+class AuditLogWriter:
+    """Batch AdminAction writes off the admin request path"""
+    
+    def __init__(self, flush_size: int, interval: float, durability: str):
+        self.flush_size = flush_size
+        self.interval = interval
+        self.durability = durability
+        self.pending: List[dict] = []
+        self.flush_task: Optional[asyncio.Task] = None
+        self.tasks = set()
+    
+    async def log(self, action: AdminAction):
+        if self.durability == "sync":
+            await db.admin_actions.insert_one(action.dict())
+            return
+        
+        self.pending.append(action.dict())
+        if len(self.pending) >= self.flush_size:
+            self._spawn(self.flush())
+        else:
+            self._schedule_flush()
+    
+    def _spawn(self, coro) -> asyncio.Task:
+        task = asyncio.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+    
+    def _schedule_flush(self):
+        # A timer that is already running its flush won't pick up entries logged meanwhile
+        if self.flush_task is None or self.flush_task.done() or self.flush_task is asyncio.current_task():
+            self.flush_task = self._spawn(self.flush_later())
+    
+    async def flush_later(self):
+        await asyncio.sleep(self.interval)
+        await self.flush()
+    
+    async def flush(self):
+        pending, self.pending = self.pending, []
+        if pending:
+            # insert_many sets _id on the dicts it is given, keep the queued entries clean for retries
+            failed = pending
+            try:
+                await db.admin_actions.insert_many([dict(entry) for entry in pending], ordered=False)
+                failed = []
+            except BulkWriteError as e:
+                # Duplicate ids were written by an earlier attempt, only retry the other errors
+                failed = [
+                    pending[error["index"]] for error in e.details.get("writeErrors", [])
+                    if error.get("code") != 11000
+                ]
+                if failed:
+                    logger.exception(f"Failed to write {len(failed)} audit entries, retrying")
+            except Exception:
+                # Entries written before the failure come back as duplicate ids on the retry
+                logger.exception(f"Failed to write {len(pending)} audit entries, retrying")
+            self.pending = failed + self.pending
+        
+        if self.pending:
+            self._schedule_flush()
+    
+    async def close(self):
+        """Flush on shutdown, waiting for writes already in flight so their failures are retried"""
+        await self.flush()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        await self.flush()
+
+audit_writer = AuditLogWriter(AUDIT_FLUSH_SIZE, AUDIT_FLUSH_INTERVAL, AUDIT_DURABILITY)
+
+# Background job tasks started at startup, cancelled at shutdown
+background_tasks: List[asyncio.Task] = []
+
+async def run_periodically(name: str, interval: timedelta, job, *args):
+    """Run a background job every interval on whichever worker holds its lease"""
+    while True:
+        # Lease expires before the next tick so the job isn't skipped on timing jitter
+        lease = interval / 2
+        started_at = datetime.now(timezone.utc)
+        if await acquire_job_lock(name, lease=lease):
+            # Renewed while the job runs so a long run can't overlap another worker's
+            holder = asyncio.create_task(hold_job_lock(name, lease))
+            try:
+                await job(*args)
+            except Exception:
+                logger.exception(f"Background job {name} failed")
+            finally:
+                holder.cancel()
+                # Other workers still skip this tick, but a long run frees the lease right away
+                await release_job_lock(name, until=started_at + lease)
+        await asyncio.sleep(interval.total_seconds())
+
+async def migrate_embedded_post_likes():
+    """Move legacy embedded `likes` arrays on posts into the post_likes collection"""
+    async for post in db.posts.find({"likes": {"$exists": True}}, {"id": 1, "likes": 1}):
+        liker_ids = list(dict.fromkeys(post.get("likes") or []))
+        if liker_ids:
+            try:
+                await db.post_likes.insert_many(
+                    [PostLike(post_id=post["id"], user_id=user_id).dict() for user_id in liker_ids],
+                    ordered=False
+                )
+            except BulkWriteError:
+                pass  # Likes already migrated by an earlier, interrupted run
+        await db.posts.update_one(
+            {"id": post["id"]},
+            {"$set": {"likes_count": len(liker_ids)}, "$unset": {"likes": ""}}
+        )
+
+async def migrate_embedded_post_comments():
+    """Move legacy embedded `comments` arrays on posts into the post_comments collection"""
+    async for post in db.posts.find({"comments_count": {"$exists": False}}, {"id": 1, "comments": 1}):
+        comments = []
+        for comment in post.get("comments") or []:
+            created_at = comment.get("created_at")
+            if isinstance(created_at, str):
+                created_at = datetime.fromisoformat(created_at)
+            comments.append(PostComment(
+                id=comment.get("id") or str(uuid.uuid4()),
+                post_id=post["id"],
+                content=comment.get("content", ""),
+                user_id=comment.get("user_id", ""),
+                user_name=comment.get("user_name", ""),
+                created_at=created_at or datetime.now(timezone.utc)
+            ).dict())
+        
+        if comments:
+            await db.post_comments.delete_many({"post_id": post["id"]})
+            await db.post_comments.insert_many([comment.copy() for comment in comments])
+        await db.posts.update_one(
+            {"id": post["id"]},
+            {"$set": {
+                "comments_count": len(comments),
+                "comments": comments[-POST_COMMENT_PREVIEW_SIZE:]
+            }}
+        )
+
+async def backfill_message_conversation_ids():
+    """Set conversation_id on messages stored before it existed"""
+    await db.messages.update_many(
+        {"conversation_id": {"$exists": False}},
+        [{"$set": {"conversation_id": {"$cond": [
+            {"$lt": ["$sender_id", "$receiver_id"]},
+            {"$concat": ["$sender_id", ":", "$receiver_id"]},
+            {"$concat": ["$receiver_id", ":", "$sender_id"]}
+        ]}}}]
+    )
+
+async def backfill_user_search_fields():
+    """Set the directory search fields on users created before they existed"""
+    await db.users.update_many(
+        {"name_lower": {"$exists": False}},
+        [{"$set": {
+            "name_lower": {"$toLower": {"$trim": {"input": "$name"}}},
+            "location_lower": {"$toLower": {"$trim": {"input": {"$ifNull": ["$location", ""]}}}}
+        }}]
+    )
+
+async def backfill_post_locations():
+    """Set the feed location on posts created before it existed and add them to the timelines"""
+    creator_ids = await db.posts.distinct("creator_id", {"location": {"$exists": False}})
+    if not creator_ids:
+        return
+    
+    creators = await db.users.find({"id": {"$in": creator_ids}}, {"_id": 0, "id": 1, "location": 1}).to_list(None)
+    locations = {creator["id"]: creator.get("location", "") for creator in creators}
+    await db.posts.bulk_write([
+        UpdateMany(
+            {"creator_id": creator_id, "location": {"$exists": False}},
+            {"$set": {"location": locations.get(creator_id, "")}}
+        )
+        for creator_id in creator_ids
+    ], ordered=False)
+    
+    # Seed each affected location's timeline with its newest posts
+    variants = {}
+    for location in await db.posts.distinct("location"):
+        variants.setdefault(get_feed_key(location), []).append(location)
+    for key in {get_feed_key(locations.get(creator_id, "")) for creator_id in creator_ids}:
+        posts = await db.posts.find(
+            {"location": {"$in": variants.get(key, [])}}, {"_id": 0, "id": 1, "created_at": 1}
+        ).sort("created_at", -1).limit(FEED_TIMELINE_SIZE).to_list(FEED_TIMELINE_SIZE)
+        await merge_into_timeline(key, posts)
+
+async def backfill_chat_rooms():
+    """Build conversation summaries from existing messages on first run"""
+    if await db.chat_rooms.estimated_document_count() > 0:
+        return
+    
+    unread_pipeline = [
+        {"$match": {"is_read": False}},
+        {"$group": {"_id": {"conversation_id": "$conversation_id", "receiver_id": "$receiver_id"}, "count": {"$sum": 1}}}
+    ]
+    unread_counts = {}
+    async for row in db.messages.aggregate(unread_pipeline):
+        unread_counts.setdefault(row["_id"]["conversation_id"], {})[row["_id"]["receiver_id"]] = row["count"]
+    
+    last_message_pipeline = [
+        {"$sort": {"created_at": -1}},
+        {"$group": {
+            "_id": "$conversation_id",
+            "last_message": {"$first": "$$ROOT"},
+            "created_at": {"$min": "$created_at"}
+        }}
+    ]
+    async for row in db.messages.aggregate(last_message_pipeline, allowDiskUse=True):
+        last = row["last_message"]
+        chat_room = ChatRoom(
+            id=row["_id"],
+            participants=sorted({last["sender_id"], last["receiver_id"]}),
+            last_message=last["content"],
+            last_message_id=last["id"],
+            last_sender_id=last["sender_id"],
+            last_message_time=last["created_at"],
+            unread_counts=unread_counts.get(row["_id"], {}),
+            created_at=row["created_at"],
+            updated_at=last["created_at"]
+        )
+        await db.chat_rooms.update_one({"id": chat_room.id}, {"$setOnInsert": chat_room.dict()}, upsert=True)
+
 # Payment Models
 class PaymentOrder(BaseModel):
     amount: int  # in paise
@@ -417,6 +1086,19 @@ class PaymentVerification(BaseModel):
     razorpay_payment_id: str
     razorpay_signature: str
 
+class LedgerEntry(BaseModel):
+    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    entry_type: str  # "subscription", "competition_entry"
+    amount: int  # in paise
+    currency: str = "INR"
+    payment_id: str  # Razorpay payment ID, one entry per payment
+    order_id: Optional[str] = ""
+    user_id: str
+    library_id: Optional[str] = None
+    plan_id: Optional[str] = None
+    competition_id: Optional[str] = None
+    created_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+
 
 
 # --- AUTH ENDPOINTS ---
@@ -459,6 +1141,7 @@ async def register(user_data: UserCreate):
     hashed_password = hash_password(user_data.password)
     user_dict = user.dict()
     user_dict["password"] = hashed_password
+    user_dict.update(user_search_fields(user.name, user.location))
     
     await db.users.insert_one(user_dict)
     
@@ -765,6 +1448,127 @@ async def get_my_bookings(current_user: dict = Depends(get_current_user)):
     bookings = await db.bookings.find(query).to_list(100)
     return [Booking(**booking) for booking in bookings]
 
+# Premium plan analytics, recomputed by a batch job over the last LIBRARY_ANALYTICS_WINDOW_DAYS
+LIBRARY_ANALYTICS_WINDOW_DAYS = int(os.environ.get('LIBRARY_ANALYTICS_WINDOW_DAYS', '30'))
+LIBRARY_ANALYTICS_INTERVAL = timedelta(minutes=int(os.environ.get('LIBRARY_ANALYTICS_INTERVAL_MINUTES', '60')))
+LIBRARY_ANALYTICS_PEAK_HOURS = 3
+
+def compute_library_analytics(slots: List[dict], bookings: List[dict]) -> Dict[str, dict]:
+    """Occupancy per slot/day, peak hours and repeat students for every library, vectorised"""
+    if not slots:
+        return {}
+    
+    slots_df = pd.DataFrame(slots, columns=["id", "library_id", "date", "start_time", "end_time", "available_seats"])
+    bookings_df = pd.DataFrame(bookings, columns=["library_id", "time_slot_id", "student_id", "seats_booked"])
+    
+    slots_df["booked"] = slots_df["id"].map(
+        bookings_df.groupby("time_slot_id")["seats_booked"].sum()
+    ).fillna(0).astype(int)
+    slots_df["capacity"] = slots_df["available_seats"].fillna(0).astype(int)
+    slots_df["hour"] = pd.to_numeric(slots_df["start_time"].str.slice(0, 2), errors="coerce")
+    
+    def with_occupancy(df: pd.DataFrame) -> pd.DataFrame:
+        df["occupancy"] = np.where(df["capacity"] > 0, df["booked"] / df["capacity"].clip(lower=1), 0.0).round(4)
+        return df
+    
+    slots_df = with_occupancy(slots_df)
+    daily = with_occupancy(slots_df.groupby(["library_id", "date"], as_index=False)[["capacity", "booked"]].sum())
+    hourly = with_occupancy(
+        slots_df.dropna(subset=["hour"]).groupby(["library_id", "hour"], as_index=False)[["capacity", "booked"]].sum()
+    )
+    hourly["hour"] = hourly["hour"].astype(int)
+    peak_hours = hourly.sort_values(["library_id", "occupancy", "booked"], ascending=[True, False, False]) \
+        .groupby("library_id").head(LIBRARY_ANALYTICS_PEAK_HOURS)
+    
+    visits = bookings_df.groupby(["library_id", "student_id"]).size().rename("visits").reset_index()
+    students = visits.groupby("library_id").agg(
+        unique_students=("visits", "size"),
+        repeat_students=("visits", lambda counts: int((counts > 1).sum()))
+    )
+    
+    slot_columns = ["date", "start_time", "end_time", "capacity", "booked", "occupancy"]
+    analytics = {}
+    for library_id, library_slots in slots_df.groupby("library_id"):
+        library_daily = daily[daily["library_id"] == library_id]
+        totals = library_daily[["capacity", "booked"]].sum()
+        student_counts = students.loc[library_id] if library_id in students.index else None
+        analytics[library_id] = {
+            "occupancy_rate": round(float(totals["booked"] / totals["capacity"]), 4) if totals["capacity"] else 0.0,
+            "slots": library_slots.sort_values(["date", "start_time"])[slot_columns].to_dict("records"),
+            "daily": library_daily[["date", "capacity", "booked", "occupancy"]].sort_values("date").to_dict("records"),
+            "peak_hours": peak_hours[peak_hours["library_id"] == library_id][["hour", "booked", "occupancy"]].to_dict("records"),
+            "unique_students": int(student_counts["unique_students"]) if student_counts is not None else 0,
+            "repeat_students": int(student_counts["repeat_students"]) if student_counts is not None else 0
+        }
+    return analytics
+
+async def run_library_analytics():
+    """Recompute the analytics cache for every library on an active premium plan"""
+    library_ids = await db.library_subscriptions.distinct("library_id", {
+        "plan_id": "premium",
+        "status": "active",
+        "end_date": {"$gt": datetime.now(timezone.utc)}
+    })
+    if not library_ids:
+        return
+    
+    today = datetime.now(timezone.utc)
+    window = {
+        "$gte": (today - timedelta(days=LIBRARY_ANALYTICS_WINDOW_DAYS)).strftime("%Y-%m-%d"),
+        "$lte": today.strftime("%Y-%m-%d")
+    }
+    slots = await db.time_slots.find(
+        {"library_id": {"$in": library_ids}, "date": window},
+        {"_id": 0, "id": 1, "library_id": 1, "date": 1, "start_time": 1, "end_time": 1, "available_seats": 1}
+    ).to_list(None)
+    bookings = await db.bookings.find(
+        {"library_id": {"$in": library_ids}, "date": window, "status": "confirmed"},
+        {"_id": 0, "library_id": 1, "time_slot_id": 1, "student_id": 1, "seats_booked": 1}
+    ).to_list(None)
+    
+    # pandas work is CPU-bound, keep it off the event loop
+    analytics = await asyncio.to_thread(compute_library_analytics, slots, bookings)
+    
+    computed_at = datetime.now(timezone.utc)
+    await db.library_analytics.bulk_write([
+        UpdateOne(
+            {"library_id": library_id},
+            {"$set": {
+                "library_id": library_id,
+                "window_days": LIBRARY_ANALYTICS_WINDOW_DAYS,
+                "computed_at": computed_at,
+                **analytics.get(library_id, {
+                    "occupancy_rate": 0.0, "slots": [], "daily": [], "peak_hours": [],
+                    "unique_students": 0, "repeat_students": 0
+                })
+            }},
+            upsert=True
+        )
+        for library_id in library_ids
+    ], ordered=False)
+
+@api_router.get("/libraries/{library_id}/analytics")
+async def get_library_analytics(library_id: str, current_user: dict = Depends(get_current_user)):
+    """Occupancy analytics for a library on the premium plan, refreshed by a batch job"""
+    if current_user["role"] != "admin":
+        library = await db.libraries.find_one({"id": library_id, "owner_id": current_user["id"]}, {"_id": 1})
+        if not library:
+            raise HTTPException(status_code=403, detail="Library not found or not owned by user")
+        
+        subscription = await db.library_subscriptions.find_one({
+            "library_id": library_id,
+            "plan_id": "premium",
+            "status": "active",
+            "end_date": {"$gt": datetime.now(timezone.utc)}
+        }, {"_id": 1})
+        if not subscription:
+            raise HTTPException(status_code=403, detail="Advanced analytics require the premium plan")
+    
+    analytics = await db.library_analytics.find_one({"library_id": library_id}, {"_id": 0})
+    if not analytics:
+        raise HTTPException(status_code=404, detail="Analytics not computed yet, check back later")
+    return analytics
+
 # --- SUBSCRIPTION & PAYMENT ENDPOINTS ---
 
 # Predefined subscription plans
@@ -793,6 +1597,93 @@ SUBSCRIPTION_PLANS = [
     )
 ]
 
+async def record_ledger_entry(entry: LedgerEntry) -> bool:
+    """Append a payment to the ledger and add it to its day's running totals.
+    
+    Returns False if the payment was already recorded.
+    """
+    try:
+        await db.ledger.insert_one(entry.dict())
+    except DuplicateKeyError:
+        # An earlier attempt may have stopped before adding the entry to its day, rebuild it
+        await recompute_ledger_days({entry.created_at.strftime("%Y-%m-%d")})
+        return False
+    
+    await db.ledger_daily.update_one(
+        {"day": entry.created_at.strftime("%Y-%m-%d")},
+        {"$inc": {"total": entry.amount, "count": 1, f"by_type.{entry.entry_type}": entry.amount}},
+        upsert=True
+    )
+    return True
+
+async def recompute_ledger_days(days: Set[str]):
+    """Rebuild the running totals of the given days from their ledger entries"""
+    for day in days:
+        start = datetime.strptime(day, "%Y-%m-%d").replace(tzinfo=timezone.utc)
+        by_type = await db.ledger.aggregate([
+            {"$match": {"created_at": {"$gte": start, "$lt": start + timedelta(days=1)}}},
+            {"$group": {"_id": "$entry_type", "total": {"$sum": "$amount"}, "count": {"$sum": 1}}}
+        ]).to_list(None)
+        await db.ledger_daily.update_one(
+            {"day": day},
+            {"$set": {
+                "total": sum(row["total"] for row in by_type),
+                "count": sum(row["count"] for row in by_type),
+                "by_type": {row["_id"]: row["total"] for row in by_type}
+            }},
+            upsert=True
+        )
+
+async def backfill_ledger():
+    """Record payments made before the ledger existed.
+    
+    Safe to re-run: entries are unique per payment and the days they fall on are
+    rebuilt from the ledger, so an interrupted backfill completes on the next start.
+    """
+    entries = []
+    orders = {
+        order["order_id"]: order
+        async for order in db.payment_orders.find({"status": "completed"}, {"_id": 0, "order_id": 1, "user_id": 1, "amount": 1})
+    }
+    plan_prices = {plan.id: plan.price for plan in SUBSCRIPTION_PLANS}
+    async for subscription in db.library_subscriptions.find({"is_trial": {"$ne": True}, "order_id": {"$in": list(orders)}}):
+        order = orders[subscription["order_id"]]
+        entries.append(LedgerEntry(
+            entry_type="subscription",
+            amount=order.get("amount", plan_prices.get(subscription["plan_id"], 0)),
+            payment_id=subscription["payment_id"],
+            order_id=subscription["order_id"],
+            user_id=order["user_id"],
+            library_id=subscription["library_id"],
+            plan_id=subscription["plan_id"],
+            created_at=subscription["start_date"]
+        ))
+    
+    entry_fees = {
+        competition["id"]: competition["entry_fee"]
+        async for competition in db.competitions.find({"entry_fee": {"$gt": 0}}, {"_id": 0, "id": 1, "entry_fee": 1})
+    }
+    async for registration in db.competition_registrations.find({
+        "payment_status": "completed",
+        "payment_id": {"$ne": None},
+        "competition_id": {"$in": list(entry_fees)}
+    }):
+        entries.append(LedgerEntry(
+            entry_type="competition_entry",
+            amount=entry_fees[registration["competition_id"]],
+            payment_id=registration["payment_id"],
+            user_id=registration["student_id"],
+            competition_id=registration["competition_id"],
+            created_at=registration["registration_date"]
+        ))
+    
+    for entry in entries:
+        try:
+            await db.ledger.insert_one(entry.dict())
+        except DuplicateKeyError:
+            pass  # Recorded by an earlier run
+    await recompute_ledger_days({entry.created_at.strftime("%Y-%m-%d") for entry in entries})
+
 @api_router.get("/subscription-plans", response_model=List[SubscriptionPlan])
 async def get_subscription_plans():
     return SUBSCRIPTION_PLANS
@@ -867,6 +1758,15 @@ async def verify_payment(payment_data: PaymentVerification, current_user: dict =
         )
         
         await db.library_subscriptions.insert_one(subscription.dict())
+        await record_ledger_entry(LedgerEntry(
+            entry_type="subscription",
+            amount=order["amount"],
+            payment_id=payment_data.razorpay_payment_id,
+            order_id=payment_data.razorpay_order_id,
+            user_id=current_user["id"],
+            library_id=order["library_id"],
+            plan_id=order["plan_id"]
+        ))
         
         # Update order status
         await db.payment_orders.update_one(
@@ -936,7 +1836,7 @@ async def create_competition(comp_data: CompetitionCreate, admin_user: dict = De
         target_type="competition",
         reason=f"Created competition: {competition.title}"
     )
-    await db.admin_actions.insert_one(admin_action.dict())
+    await audit_writer.log(admin_action)
     
     return competition
 
@@ -1141,6 +2041,16 @@ async def verify_competition_payment(
         if result.matched_count == 0:
             raise HTTPException(status_code=404, detail="Registration not found")
         
+        competition = await db.competitions.find_one({"id": competition_id}, {"entry_fee": 1})
+        await record_ledger_entry(LedgerEntry(
+            entry_type="competition_entry",
+            amount=competition["entry_fee"] if competition else 0,
+            payment_id=payment_data.razorpay_payment_id,
+            order_id=payment_data.razorpay_order_id,
+            user_id=current_user["id"],
+            competition_id=competition_id
+        ))
+        
         return {"message": "Payment verified and registration completed successfully"}
         
     except razorpay.errors.SignatureVerificationError:
@@ -1267,7 +2177,7 @@ async def update_competition_status(
         target_type="competition",
         reason=f"Status changed to {new_status}"
     )
-    await db.admin_actions.insert_one(admin_action.dict())
+    await audit_writer.log(admin_action)
     
     return {"message": f"Competition status updated to {new_status}"}
 
@@ -1296,7 +2206,11 @@ async def get_competition_analytics(competition_id: str, admin_user: dict = Depe
     # Get revenue if paid competition
     total_revenue = 0
     if competition["entry_fee"] > 0:
-        total_revenue = completed_registrations * competition["entry_fee"]
+        revenue_result = await db.ledger.aggregate([
+            {"$match": {"competition_id": competition_id}},
+            {"$group": {"_id": None, "total_revenue": {"$sum": "$amount"}}}
+        ]).to_list(1)
+        total_revenue = revenue_result[0]["total_revenue"] if revenue_result else 0
     
     # Get registration timeline (registrations by day)
     pipeline = [
@@ -1357,22 +2271,14 @@ async def get_all_competitions_statistics(admin_user: dict = Depends(get_admin_u
     total_registrations = await db.competition_registrations.count_documents({})
     completed_registrations = await db.competition_registrations.count_documents({"payment_status": "completed"})
     
-    # Revenue stats
+    # Revenue stats, summed from the ledger's per-day totals
     revenue_pipeline = [
-        {"$match": {"payment_status": "completed"}},
-        {"$lookup": {
-            "from": "competitions",
-            "localField": "competition_id",
-            "foreignField": "id",
-            "as": "competition"
-        }},
-        {"$unwind": "$competition"},
         {"$group": {
             "_id": None,
-            "total_revenue": {"$sum": "$competition.entry_fee"}
+            "total_revenue": {"$sum": "$by_type.competition_entry"}
         }}
     ]
-    revenue_result = await db.competition_registrations.aggregate(revenue_pipeline).to_list(1)
+    revenue_result = await db.ledger_daily.aggregate(revenue_pipeline).to_list(1)
     total_revenue = revenue_result[0]["total_revenue"] if revenue_result else 0
     
     # Top competitions by participants
@@ -1453,7 +2359,7 @@ async def send_competition_notification(
         target_type="competition",
         reason=f"Sent notification to {participant_count} participants"
     )
-    await db.admin_actions.insert_one(admin_action.dict())
+    await audit_writer.log(admin_action)
     
     return {
         "message": f"Notification sent to {participant_count} participants",
@@ -1506,146 +2412,784 @@ async def like_note(note_id: str, current_user: dict = Depends(get_current_user)
 
 # --- SOCIAL FEED ENDPOINTS ---
 
-@api_router.post("/posts", response_model=Post)
+def get_feed_key(location: str) -> str:
+    """Timeline key shared by all users in the same location"""
+    return location.strip().lower()
+
+def to_naive_utc(value: datetime) -> datetime:
+    """Normalise a datetime for comparison with the naive UTC values MongoDB returns"""
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+def get_feed_room(location: str) -> str:
+    """Socket.IO room for clients following a location's feed"""
+    return f"feed:{get_feed_key(location)}"
+
+class PostEmitCoalescer:
+    """Batch new-post events per room and emit them as one frame per interval"""
+    
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.pending: Dict[str, List[Dict[str, Any]]] = {}
+        self.flush_task: Optional[asyncio.Task] = None
+    
+    def add(self, room: str, payload: Dict[str, Any]):
+        self.pending.setdefault(room, []).append(payload)
+        self._schedule_flush()
+    
+    def _schedule_flush(self):
+        # A timer that is already running its flush won't pick up posts added meanwhile
+        if self.flush_task is None or self.flush_task.done() or self.flush_task is asyncio.current_task():
+            self.flush_task = asyncio.create_task(self.flush_later())
+    
+    async def flush_later(self):
+        await asyncio.sleep(self.interval)
+        await self.flush()
+    
+    async def flush(self):
+        pending, self.pending = self.pending, {}
+        for room, posts in pending.items():
+            await sio.emit('new_posts', {"posts": posts}, room=room)
+        if self.pending:
+            self._schedule_flush()
+
+post_emitter = PostEmitCoalescer(POST_EMIT_INTERVAL)
+
+async def merge_into_timeline(key: str, posts: List[dict], heavy_poster: Optional[str] = None):
+    """Add posts missing from a location's timeline, keeping it sorted and capped.
+    
+    With heavy_poster, also moves that creator back to fan-out-on-write.
+    """
+    timeline = await db.feed_timelines.find_one({"key": key}, {"entries.post_id": 1})
+    present = {entry["post_id"] for entry in (timeline or {}).get("entries", [])}
+    update = {"$push": {"entries": {
+        "$each": [{"post_id": post["id"], "created_at": post["created_at"]} for post in posts if post["id"] not in present],
+        "$sort": {"created_at": -1},
+        "$slice": FEED_TIMELINE_SIZE
+    }}}
+    if heavy_poster:
+        update["$pull"] = {"heavy_posters": heavy_poster}
+    await db.feed_timelines.update_one({"key": key}, update, upsert=True)
+
+async def prune_heavy_posters():
+    """Move creators whose posting rate dropped back under the threshold to fan-out-on-write"""
+    since = datetime.now(timezone.utc) - timedelta(hours=1)
+    async for timeline in db.feed_timelines.find({"heavy_posters.0": {"$exists": True}}, {"key": 1, "heavy_posters": 1}):
+        for creator_id in timeline["heavy_posters"]:
+            recent_posts = await db.posts.count_documents({"creator_id": creator_id, "created_at": {"$gte": since}})
+            if recent_posts > FEED_HEAVY_POSTER_THRESHOLD:
+                continue
+            
+            # Their posts were never pushed, so backfill them into the timeline as they leave the list
+            posts = await db.posts.find(
+                {"creator_id": creator_id}, {"_id": 0, "id": 1, "created_at": 1, "location": 1}
+            ).sort("created_at", -1).limit(FEED_TIMELINE_SIZE).to_list(FEED_TIMELINE_SIZE)
+            await merge_into_timeline(
+                timeline["key"],
+                [post for post in posts if get_feed_key(post.get("location", "")) == timeline["key"]],
+                heavy_poster=creator_id
+            )
+
+async def fan_out_post(post: Post):
+    """Push a new post onto its location's timeline (fan-out-on-write)"""
+    key = get_feed_key(post.location)
+    
+    # Heavy posters would flood the capped timeline, their posts are merged in at read time
+    recent_posts = await db.posts.count_documents({
+        "creator_id": post.creator_id,
+        "created_at": {"$gte": datetime.now(timezone.utc) - timedelta(hours=1)}
+    })
+    if recent_posts > FEED_HEAVY_POSTER_THRESHOLD:
+        await db.feed_timelines.update_one(
+            {"key": key},
+            {"$addToSet": {"heavy_posters": post.creator_id}},
+            upsert=True
+        )
+        return
+    
+    await db.feed_timelines.update_one(
+        {"key": key},
+        {"$push": {"entries": {
+            "$each": [{"post_id": post.id, "created_at": post.created_at}],
+            "$sort": {"created_at": -1},
+            "$slice": FEED_TIMELINE_SIZE
+        }}},
+        upsert=True
+    )
+
+@api_router.post("/posts", response_model=Post, dependencies=[Depends(rate_limit("posts"))])
 async def create_post(post_data: PostCreate, current_user: dict = Depends(get_current_user)):
     if current_user["role"] != "student":
         raise HTTPException(status_code=403, detail="Only students can create posts")
     
-    post = Post(**post_data.dict(), creator_id=current_user["id"])
+    post = Post(**post_data.dict(), creator_id=current_user["id"], location=current_user.get("location", ""))
     await db.posts.insert_one(post.dict())
+    await fan_out_post(post)
     
-    # Emit real-time update
-    await sio.emit('new_post', post.dict())
+    # Notify the location's feed room with a slim payload, clients fetch the post lazily
+    post_emitter.add(get_feed_room(post.location), {
+        "id": post.id,
+        "creator_id": post.creator_id,
+        "created_at": post.created_at.isoformat()
+    })
     
     return post
 
 @api_router.get("/posts", response_model=List[Post])
 async def get_posts():
-    posts = await db.posts.find().sort("created_at", -1).to_list(100)
+    posts = await db.posts.find({}, {"likes": 0}).sort("created_at", -1).to_list(100)
     return [Post(**post) for post in posts]
 
-@api_router.post("/posts/{post_id}/like")
+@api_router.get("/feed", response_model=List[Post])
+async def get_feed(
+    before: Optional[datetime] = Query(None),
+    limit: int = Query(20, ge=1, le=100),
+    current_user: dict = Depends(get_current_user)
+):
+    """Get the home feed for the current user's location, newest first, paginated by `before`"""
+    location = current_user.get("location", "")
+    before = to_naive_utc(before) if before else None
+    timeline = await db.feed_timelines.find_one({"key": get_feed_key(location)}, {"_id": 0})
+    
+    # Precomputed entries from fan-out-on-write
+    entries = []
+    heavy_posters = []
+    if timeline:
+        entries = [
+            entry for entry in timeline.get("entries", [])
+            if before is None or entry["created_at"] < before
+        ][:limit]
+        heavy_posters = timeline.get("heavy_posters", [])
+    candidates = {entry["post_id"]: entry["created_at"] for entry in entries}
+    
+    # Fan-out-on-read for heavy posters
+    if heavy_posters:
+        query = {"creator_id": {"$in": heavy_posters}}
+        if before:
+            query["created_at"] = {"$lt": before}
+        heavy_posts = await db.posts.find(
+            query, {"id": 1, "created_at": 1}
+        ).sort("created_at", -1).limit(limit).to_list(limit)
+        candidates.update({post["id"]: post["created_at"] for post in heavy_posts})
+    
+    # Paging past the end of a full (or missing) timeline falls back to the posts collection
+    timeline_full = timeline is not None and len(timeline.get("entries", [])) >= FEED_TIMELINE_SIZE
+    if len(entries) < limit and (timeline is None or timeline_full):
+        older_than = entries[-1]["created_at"] if entries else before
+        query = {"location": {"$regex": f"^{re.escape(location.strip())}$", "$options": "i"}}
+        if older_than:
+            query["created_at"] = {"$lt": older_than}
+        older_posts = await db.posts.find(
+            query, {"id": 1, "created_at": 1}
+        ).sort("created_at", -1).limit(limit - len(entries)).to_list(limit)
+        candidates.update({post["id"]: post["created_at"] for post in older_posts})
+    
+    post_ids = sorted(candidates, key=candidates.get, reverse=True)[:limit]
+    if not post_ids:
+        return []
+    
+    posts = await db.posts.find({"id": {"$in": post_ids}}, {"likes": 0}).to_list(limit)
+    posts_by_id = {post["id"]: post for post in posts}
+    return [Post(**posts_by_id[post_id]) for post_id in post_ids if post_id in posts_by_id]
+
+@api_router.post("/posts/{post_id}/like", dependencies=[Depends(rate_limit("likes"))])
 async def like_post(post_id: str, current_user: dict = Depends(get_current_user)):
-    post = await db.posts.find_one({"id": post_id})
+    """Toggle the current user's like on a post"""
+    like_filter = {"post_id": post_id, "user_id": current_user["id"]}
+    
+    # Unlike if a like exists, otherwise like
+    removed = await db.post_likes.delete_one(like_filter)
+    liked = removed.deleted_count == 0
+    post = await db.posts.find_one_and_update(
+        {"id": post_id},
+        {"$inc": {"likes_count": 1 if liked else -1}},
+        projection={"likes_count": 1},
+        return_document=ReturnDocument.AFTER
+    )
     if not post:
         raise HTTPException(status_code=404, detail="Post not found")
     
-    likes = post.get("likes", [])
-    if current_user["id"] in likes:
-        likes.remove(current_user["id"])
-    else:
-        likes.append(current_user["id"])
-    
-    await db.posts.update_one({"id": post_id}, {"$set": {"likes": likes}})
-    return {"message": "Post liked/unliked", "likes_count": len(likes)}
+    if liked:
+        try:
+            await db.post_likes.insert_one(PostLike(**like_filter).dict())
+        except DuplicateKeyError:
+            # A concurrent request already liked this post, undo our increment
+            post = await db.posts.find_one_and_update(
+                {"id": post_id},
+                {"$inc": {"likes_count": -1}},
+                projection={"likes_count": 1},
+                return_document=ReturnDocument.AFTER
+            )
+    
+    return {"message": "Post liked/unliked", "liked": liked, "likes_count": post["likes_count"]}
 
-@api_router.post("/posts/{post_id}/comment")
+@api_router.post("/posts/{post_id}/comment", dependencies=[Depends(rate_limit("comments"))])
 async def add_comment(post_id: str, comment_data: CommentCreate, current_user: dict = Depends(get_current_user)):
-    post = await db.posts.find_one({"id": post_id})
-    if not post:
-        raise HTTPException(status_code=404, detail="Post not found")
-    
-    comment = {
-        "id": str(uuid.uuid4()),
-        "content": comment_data.content,
-        "user_id": current_user["id"],
-        "user_name": current_user["name"],
-        "created_at": datetime.now(timezone.utc).isoformat()
-    }
+    comment = PostComment(
+        post_id=post_id,
+        content=comment_data.content,
+        user_id=current_user["id"],
+        user_name=current_user["name"]
+    )
+    comment_dict = comment.dict()
     
-    comments = post.get("comments", [])
-    comments.append(comment)
+    # Bump the counter and keep only the latest few comments embedded for the feed
+    result = await db.posts.update_one(
+        {"id": post_id},
+        {
+            "$inc": {"comments_count": 1},
+            "$push": {"comments": {"$each": [comment_dict], "$slice": -POST_COMMENT_PREVIEW_SIZE}}
+        }
+    )
+    if result.matched_count == 0:
+        raise HTTPException(status_code=404, detail="Post not found")
     
-    await db.posts.update_one({"id": post_id}, {"$set": {"comments": comments}})
+    await db.post_comments.insert_one(comment_dict.copy())
     return {"message": "Comment added", "comment": comment}
 
+@api_router.get("/posts/{post_id}/comments", response_model=List[PostComment])
+async def get_post_comments(
+    post_id: str,
+    before: Optional[datetime] = Query(None),
+    limit: int = Query(20, ge=1, le=100)
+):
+    """Get a post's comments, newest first, paginated by `before` the last seen created_at"""
+    query = {"post_id": post_id}
+    if before:
+        query["created_at"] = {"$lt": before}
+    
+    comments = await db.post_comments.find(query).sort("created_at", -1).limit(limit).to_list(limit)
+    return [PostComment(**comment) for comment in comments]
+
 # --- MESSAGING ENDPOINTS ---
 
-@api_router.post("/messages")
-async def send_message(message_data: MessageCreate, current_user: dict = Depends(get_current_user)):
+# Maximum number of messages returned by one resume_messages socket call
+MESSAGE_RESUME_LIMIT = 200
+
+# Messages older than this many days move to the messages_archive collection
+MESSAGE_ARCHIVE_AFTER_DAYS = int(os.environ.get('MESSAGE_ARCHIVE_AFTER_DAYS', '180'))
+MESSAGE_ARCHIVE_BATCH_SIZE = 1000
+# Archive buckets roll over to a new sequence number within the month once they hold this many
+MESSAGE_ARCHIVE_BUCKET_SIZE = int(os.environ.get('MESSAGE_ARCHIVE_BUCKET_SIZE', '1000'))
+
+# Message storage layout: "document" (one document per message) or "bucket"
+# (up to MESSAGE_BUCKET_SIZE messages per conversation bucket document)
+MESSAGE_STORAGE = os.environ.get('MESSAGE_STORAGE', 'document')
+MESSAGE_BUCKET_SIZE = int(os.environ.get('MESSAGE_BUCKET_SIZE', '200'))
+
+def get_conversation_id(user_id: str, other_user_id: str) -> str:
+    """Canonical id shared by both directions of a one-to-one conversation"""
+    return ":".join(sorted([user_id, other_user_id]))
+
+async def decrement_unread_count(conversation_id: str, user_id: str, count: int):
+    """Lower a participant's unread counter on the conversation summary, never below zero"""
+    unread_field = f"unread_counts.{user_id}"
+    await db.chat_rooms.update_one(
+        {"id": conversation_id},
+        [{"$set": {unread_field: {"$max": [0, {"$subtract": [{"$ifNull": [f"${unread_field}", 0]}, count]}]}}}]
+    )
+
+async def append_bucket_message(message: Message):
+    """Append a message to its conversation's open (highest numbered) bucket, starting the
+    next numbered bucket when it is full"""
+    # Buckets hold the participants once, so messages drop the duplicated conversation/receiver ids
+    data = message.dict(exclude={"conversation_id", "receiver_id"})
+    open_bucket = await db.message_buckets.find_one(
+        {"conversation_id": message.conversation_id},
+        {"seq": 1, "count": 1},
+        sort=[("seq", -1)]
+    )
+    seq = 0
+    if open_bucket:
+        seq = open_bucket["seq"] + (open_bucket["count"] >= MESSAGE_BUCKET_SIZE)
+    
+    while True:
+        try:
+            await db.message_buckets.update_one(
+                {"conversation_id": message.conversation_id, "seq": seq, "count": {"$lt": MESSAGE_BUCKET_SIZE}},
+                {
+                    "$push": {"messages": data},
+                    "$inc": {"count": 1},
+                    "$min": {"first_at": message.created_at},
+                    "$max": {"last_at": message.created_at},
+                    "$setOnInsert": {"participants": sorted({message.sender_id, message.receiver_id})}
+                },
+                upsert=True
+            )
+            return
+        except DuplicateKeyError:
+            # The unique (conversation_id, seq) index stopped a second bucket with this number:
+            # either a concurrent send opened it first or it filled up, so retry or move on
+            bucket = await db.message_buckets.find_one(
+                {"conversation_id": message.conversation_id, "seq": seq}, {"count": 1}
+            )
+            if bucket and bucket["count"] >= MESSAGE_BUCKET_SIZE:
+                seq += 1
+
+async def update_bucket_messages(bucket_query: dict, message_filter: dict, updates: dict) -> int:
+    """Set fields on the bucketed messages matching message_filter, returning how many changed"""
+    bucket_query = {**bucket_query, "messages": {"$elemMatch": message_filter}}
+    
+    # update_many reports changed buckets rather than messages, so count the messages first
+    counted = await db.message_buckets.aggregate([
+        {"$match": bucket_query},
+        {"$unwind": "$messages"},
+        {"$match": {f"messages.{field}": value for field, value in message_filter.items()}},
+        {"$count": "count"}
+    ]).to_list(1)
+    if not counted:
+        return 0
+    
+    await db.message_buckets.update_many(
+        bucket_query,
+        {"$set": {f"messages.$[m].{field}": value for field, value in updates.items()}},
+        array_filters=[{f"m.{field}": value for field, value in message_filter.items()}]
+    )
+    return counted[0]["count"]
+
+def expand_bucket_message(bucket: dict, message: dict) -> dict:
+    """Restore the conversation and receiver ids a bucketed message doesn't store"""
+    if "receiver_id" in message:
+        return message
+    receiver_id = next((p for p in bucket["participants"] if p != message["sender_id"]), message["sender_id"])
+    return {**message, "conversation_id": bucket["conversation_id"], "receiver_id": receiver_id}
+
+async def archive_bucket_writes(conversation_id: str, month: str, messages: List[dict]) -> List[UpdateOne]:
+    """Writes appending messages to a conversation month's archive, filling the open bucket
+    and starting numbered buckets of at most MESSAGE_ARCHIVE_BUCKET_SIZE messages after it"""
+    open_bucket = await db.messages_archive.find_one(
+        {"conversation_id": conversation_id, "month": month},
+        {"seq": 1, "count": 1},
+        sort=[("seq", -1)]
+    )
+    seq, count = (open_bucket["seq"], open_bucket["count"]) if open_bucket else (0, 0)
+    
+    writes = []
+    while messages:
+        if count >= MESSAGE_ARCHIVE_BUCKET_SIZE:
+            seq, count = seq + 1, 0
+        chunk, messages = messages[:MESSAGE_ARCHIVE_BUCKET_SIZE - count], messages[MESSAGE_ARCHIVE_BUCKET_SIZE - count:]
+        writes.append(UpdateOne(
+            {"conversation_id": conversation_id, "month": month, "seq": seq},
+            {
+                "$push": {"messages": {"$each": chunk}},
+                "$inc": {"count": len(chunk)},
+                "$min": {"first_at": chunk[0]["created_at"]},
+                "$max": {"last_at": chunk[-1]["created_at"]}
+            },
+            upsert=True
+        ))
+        count += len(chunk)
+    return writes
+
+async def archive_old_messages(max_age_days: int = MESSAGE_ARCHIVE_AFTER_DAYS) -> int:
+    """Move messages older than max_age_days into monthly per-conversation archive buckets"""
+    if MESSAGE_STORAGE == "bucket":
+        return 0  # Bucket documents are already compact, archival applies to the document layout
+    
+    cutoff = datetime.now(timezone.utc) - timedelta(days=max_age_days)
+    archived = 0
+    
+    while True:
+        batch = await db.messages.find(
+            {"created_at": {"$lt": cutoff}}, {"_id": 0}
+        ).sort("created_at", 1).limit(MESSAGE_ARCHIVE_BATCH_SIZE).to_list(MESSAGE_ARCHIVE_BATCH_SIZE)
+        if not batch:
+            break
+        
+        buckets = {}
+        unread = {}
+        for message in batch:
+            bucket_key = (message["conversation_id"], message["created_at"].strftime("%Y-%m"))
+            buckets.setdefault(bucket_key, []).append(message)
+            if not message.get("is_read"):
+                unread_key = (message["conversation_id"], message["receiver_id"])
+                unread[unread_key] = unread.get(unread_key, 0) + 1
+        
+        # A re-run after an interrupted batch skips the messages it already archived
+        already_archived = set(await db.messages_archive.distinct(
+            "messages.id", {"messages.id": {"$in": [message["id"] for message in batch]}}
+        ))
+        writes = []
+        for (conversation_id, month), messages in buckets.items():
+            messages = [message for message in messages if message["id"] not in already_archived]
+            if messages:
+                writes.extend(await archive_bucket_writes(conversation_id, month, messages))
+        if writes:
+            await db.messages_archive.bulk_write(writes, ordered=True)
+        await db.messages.delete_many({"id": {"$in": [message["id"] for message in batch]}})
+        
+        # Archived messages can no longer be marked read, so drop them from the counters
+        for (conversation_id, receiver_id), count in unread.items():
+            await decrement_unread_count(conversation_id, receiver_id, count)
+        
+        archived += len(batch)
+    
+    return archived
+
+async def find_conversation_message(conversation_id: str, message_id: str) -> Optional[dict]:
+    """Look a message up in the hot storage, then in the archive"""
+    if MESSAGE_STORAGE == "bucket":
+        bucket = await db.message_buckets.find_one(
+            {"conversation_id": conversation_id, "messages.id": message_id},
+            {"messages": {"$elemMatch": {"id": message_id}}}
+        )
+        if bucket:
+            message = bucket["messages"][0]
+            return {"id": message["id"], "created_at": message["created_at"]}
+    else:
+        message = await db.messages.find_one(
+            {"id": message_id, "conversation_id": conversation_id},
+            {"_id": 0, "id": 1, "created_at": 1}
+        )
+        if message:
+            return message
+    
+    bucket = await db.messages_archive.find_one(
+        {"conversation_id": conversation_id, "messages.id": message_id},
+        {"messages": {"$elemMatch": {"id": message_id}}}
+    )
+    if bucket:
+        archived = bucket["messages"][0]
+        return {"id": archived["id"], "created_at": archived["created_at"], "archived": True}
+    return None
+
+async def read_message_buckets(
+    collection,
+    conversation_id: str,
+    limit: int,
+    before: Optional[dict] = None,
+    after: Optional[dict] = None,
+) -> List[dict]:
+    """Read bucketed messages one bucket at a time, newest first (or oldest first with `after`)"""
+    query = {"conversation_id": conversation_id}
+    if before:
+        query["first_at"] = {"$lte": before["created_at"]}
+    if after:
+        query["last_at"] = {"$gte": after["created_at"]}
+    newest_first = after is None
+    order = lambda m: (m["created_at"], m["id"])
+    
+    # Buckets can overlap in time, so walk them by their nearest edge and only stop once
+    # the next bucket cannot hold a message that belongs in the page
+    edge = "last_at" if newest_first else "first_at"
+    result = []
+    async for bucket in collection.find(query).sort(edge, -1 if newest_first else 1):
+        if len(result) >= limit:
+            result.sort(key=order, reverse=newest_first)
+            del result[limit:]
+            boundary = result[-1]["created_at"]
+            if (bucket[edge] < boundary) if newest_first else (bucket[edge] > boundary):
+                break
+        for message in bucket["messages"]:
+            message = expand_bucket_message(bucket, message)
+            key = order(message)
+            if before and key >= (before["created_at"], before["id"]):
+                continue
+            if after and key <= (after["created_at"], after["id"]):
+                continue
+            result.append(message)
+    
+    result.sort(key=order, reverse=newest_first)
+    return result[:limit]
+
+async def resume_bucket_messages(user_id: str, last_seen_id: Optional[str]) -> List[dict]:
+    """Bucket layout version of the resume_messages query, oldest first"""
+    bucket_query = {"participants": user_id}
+    
+    last_seen = None
+    if last_seen_id:
+        last_seen = await db.message_buckets.find_one(
+            {"participants": user_id, "messages.id": last_seen_id},
+            {"messages": {"$elemMatch": {"id": last_seen_id}}}
+        )
+    if last_seen:
+        last_seen_key = (last_seen["messages"][0]["created_at"], last_seen_id)
+        bucket_query["last_at"] = {"$gte": last_seen_key[0]}
+    else:
+        last_seen_key = None
+        bucket_query["messages"] = {"$elemMatch": {"sender_id": {"$ne": user_id}, "delivered": {"$ne": True}}}
+    
+    messages = []
+    async for bucket in db.message_buckets.find(bucket_query):
+        for message in bucket["messages"]:
+            if message["sender_id"] == user_id:
+                continue
+            if last_seen_key is not None and (message["created_at"], message["id"]) <= last_seen_key:
+                continue
+            if last_seen_key is None and message.get("delivered"):
+                continue
+            messages.append(expand_bucket_message(bucket, message))
+    
+    messages.sort(key=lambda m: (m["created_at"], m["id"]))
+    return messages[:MESSAGE_RESUME_LIMIT + 1]
+
+def get_user_room(user_id: str) -> str:
+    """Socket.IO room every session of a user joins on connect"""
+    return f"user:{user_id}"
+
+@api_router.post("/messages", dependencies=[Depends(rate_limit("messages"))])
+async def send_message(message_data: MessageCreate, current_user: dict = Depends(get_current_user_role)):
     # Only students can send messages
     if current_user["role"] != "student":
         raise HTTPException(status_code=403, detail="Only students can send messages")
     
+    if not current_user.get("is_active", True):
+        raise HTTPException(status_code=403, detail="Account suspended")
+    
     # Verify receiver exists and is also a student
-    receiver = await db.users.find_one({"id": message_data.receiver_id})
+    receiver = await user_role_cache.get(message_data.receiver_id)
     if not receiver:
         raise HTTPException(status_code=404, detail="Receiver not found")
     
     if receiver["role"] != "student":
         raise HTTPException(status_code=403, detail="Can only send messages to students")
     
+    if not receiver.get("is_active", True):
+        raise HTTPException(status_code=403, detail="Receiver is not available")
+    
     message = Message(
+        conversation_id=get_conversation_id(current_user["id"], message_data.receiver_id),
         sender_id=current_user["id"],
         **message_data.dict()
     )
     
-    await db.messages.insert_one(message.dict())
+    if MESSAGE_STORAGE == "bucket":
+        await append_bucket_message(message)
+    else:
+        await db.messages.insert_one(message.dict())
     
-    # Emit real-time message (Socket.IO currently disabled, will re-enable later)
-    # await sio.emit('new_message', message.dict(), room=message_data.receiver_id)
+    # Keep the conversation summary used by the inbox up to date
+    await db.chat_rooms.update_one(
+        {"id": message.conversation_id},
+        {
+            "$set": {
+                "last_message": message.content,
+                "last_message_id": message.id,
+                "last_sender_id": message.sender_id,
+                "last_message_time": message.created_at,
+                "updated_at": message.created_at
+            },
+            "$setOnInsert": {
+                "participants": sorted({message.sender_id, message.receiver_id}),
+                "created_at": message.created_at
+            },
+            "$inc": {f"unread_counts.{message.receiver_id}": 1}
+        },
+        upsert=True
+    )
+    
+    # Push to the receiver and to the sender's other sessions
+    await sio.emit(
+        'new_message',
+        jsonable_encoder(message),
+        room=[get_user_room(message.receiver_id), get_user_room(current_user["id"])]
+    )
     
     return {"message": "Message sent successfully", "message_id": message.id}
 
 @api_router.get("/messages/{user_id}")
-async def get_conversation(user_id: str, current_user: dict = Depends(get_current_user)):
-    messages = await db.messages.find({
-        "$or": [
-            {"sender_id": current_user["id"], "receiver_id": user_id},
-            {"sender_id": user_id, "receiver_id": current_user["id"]}
+async def get_conversation(
+    user_id: str,
+    before: Optional[str] = Query(None),
+    after: Optional[str] = Query(None),
+    limit: int = Query(50, ge=1, le=200),
+    current_user: dict = Depends(get_current_user)
+):
+    """Get a conversation in chronological order.
+    
+    Without cursors returns the latest messages; `before` pages back through history
+    and `after` returns only messages newer than the given message id (for polling).
+    """
+    conversation_id = get_conversation_id(current_user["id"], user_id)
+    query = {"conversation_id": conversation_id}
+    
+    cursor = None
+    cursor_id = after or before
+    if cursor_id:
+        cursor = await find_conversation_message(conversation_id, cursor_id)
+        if not cursor:
+            raise HTTPException(status_code=404, detail="Cursor message not found")
+        
+        # Order by (created_at, id) so messages sharing a timestamp are never skipped
+        op = "$gt" if after else "$lt"
+        query["$or"] = [
+            {"created_at": {op: cursor["created_at"]}},
+            {"created_at": cursor["created_at"], "id": {op: cursor["id"]}}
         ]
-    }).sort("created_at", 1).to_list(1000)
+    
+    if MESSAGE_STORAGE == "bucket":
+        messages = await read_message_buckets(
+            db.message_buckets, conversation_id, limit,
+            before=cursor if before else None,
+            after=cursor if after else None
+        )
+        if not after:
+            messages.reverse()
+        return [Message(**msg) for msg in messages]
+    
+    direction = 1 if after else -1
+    messages = await db.messages.find(query).sort(
+        [("created_at", direction), ("id", direction)]
+    ).limit(limit).to_list(limit)
+    if direction == -1:
+        messages.reverse()
+    
+    # Page transparently into the archive once the hot collection runs out
+    if after and cursor.get("archived"):
+        archived = await read_message_buckets(db.messages_archive, conversation_id, limit, after=cursor)
+        messages = (archived + messages)[:limit]
+    elif not after and len(messages) < limit:
+        boundary = messages[0] if messages else cursor
+        archived = await read_message_buckets(
+            db.messages_archive, conversation_id, limit - len(messages), before=boundary
+        )
+        messages = list(reversed(archived)) + messages
     
     return [Message(**msg) for msg in messages]
 
 @api_router.get("/conversations")
 async def get_conversations(current_user: dict = Depends(get_current_user)):
-    # Get unique users who have messaged with current user
-    pipeline = [
-        {"$match": {
-            "$or": [
-                {"sender_id": current_user["id"]},
-                {"receiver_id": current_user["id"]}
-            ]
-        }},
-        {"$sort": {"created_at": -1}},
-        {"$group": {
-            "_id": {
-                "$cond": [
-                    {"$eq": ["$sender_id", current_user["id"]]},
-                    "$receiver_id",
-                    "$sender_id"
-                ]
-            },
-            "last_message": {"$first": "$$ROOT"}
-        }}
-    ]
-    
-    conversations = await db.messages.aggregate(pipeline).to_list(100)
+    """Get the current user's conversations, most recent first, from the maintained summaries"""
+    chat_rooms = await db.chat_rooms.find(
+        {"participants": current_user["id"]}
+    ).sort("last_message_time", -1).to_list(100)
+    
+    # One batched lookup for every conversation peer
+    peer_ids = {
+        next((p for p in room["participants"] if p != current_user["id"]), current_user["id"])
+        for room in chat_rooms
+    }
+    users = await db.users.find({"id": {"$in": list(peer_ids)}}, {"password": 0}).to_list(len(peer_ids))
+    users_by_id = {user["id"]: user for user in users}
     
-    # Get user details for each conversation
     result = []
-    for conv in conversations:
-        user = await db.users.find_one({"id": conv["_id"]})
+    for room in chat_rooms:
+        peer_id = next((p for p in room["participants"] if p != current_user["id"]), current_user["id"])
+        user = users_by_id.get(peer_id)
         if user:
             result.append({
-                "user": UserResponse(**{k: v for k, v in user.items() if k != "password"}),
-                "last_message": Message(**conv["last_message"])
+                "conversation_id": room["id"],
+                "user": UserResponse(**user),
+                "last_message": {
+                    "id": room.get("last_message_id"),
+                    "sender_id": room.get("last_sender_id"),
+                    "content": room.get("last_message"),
+                    "created_at": room.get("last_message_time")
+                },
+                "unread_count": room.get("unread_counts", {}).get(current_user["id"], 0)
             })
     
     return result
 
+@api_router.get("/conversations/unread")
+async def get_unread_total(current_user: dict = Depends(get_current_user)):
+    """Get the current user's unread message total from the conversation counters"""
+    unread_field = f"$unread_counts.{current_user['id']}"
+    pipeline = [
+        {"$match": {"participants": current_user["id"]}},
+        {"$group": {
+            "_id": None,
+            "unread_total": {"$sum": {"$ifNull": [unread_field, 0]}},
+            "conversations_with_unread": {"$sum": {"$cond": [{"$gt": [{"$ifNull": [unread_field, 0]}, 0]}, 1, 0]}}
+        }}
+    ]
+    result = await db.chat_rooms.aggregate(pipeline).to_list(1)
+    
+    return {
+        "unread_total": result[0]["unread_total"] if result else 0,
+        "conversations_with_unread": result[0]["conversations_with_unread"] if result else 0
+    }
+
+@api_router.post("/conversations/{user_id}/read")
+async def mark_conversation_read(
+    user_id: str,
+    read_data: ConversationRead,
+    current_user: dict = Depends(get_current_user)
+):
+    """Mark every message received in a conversation up to a given message as read"""
+    conversation_id = get_conversation_id(current_user["id"], user_id)
+    query = {"conversation_id": conversation_id, "receiver_id": current_user["id"], "is_read": False}
+    
+    up_to = None
+    if read_data.up_to_message_id:
+        up_to = await find_conversation_message(conversation_id, read_data.up_to_message_id)
+        if not up_to:
+            raise HTTPException(status_code=404, detail="Message not found")
+        query["$or"] = [
+            {"created_at": {"$lt": up_to["created_at"]}},
+            {"created_at": up_to["created_at"], "id": {"$lte": up_to["id"]}}
+        ]
+    
+    if MESSAGE_STORAGE == "bucket":
+        message_filter = {"sender_id": {"$ne": current_user["id"]}, "is_read": False}
+        if up_to:
+            message_filter["created_at"] = {"$lte": up_to["created_at"]}
+        marked_read = await update_bucket_messages(
+            {"conversation_id": conversation_id}, message_filter, {"is_read": True}
+        )
+    else:
+        result = await db.messages.update_many(query, {"$set": {"is_read": True}})
+        marked_read = result.modified_count
+    
+    if marked_read:
+        await decrement_unread_count(conversation_id, current_user["id"], marked_read)
+        
+        # Read receipt for the other participant's sessions
+        await sio.emit('messages_read', {
+            "conversation_id": conversation_id,
+            "reader_id": current_user["id"],
+            "up_to_message_id": read_data.up_to_message_id
+        }, room=get_user_room(user_id))
+    
+    return {"message": "Conversation marked as read", "marked_read": marked_read}
+
+@api_router.get("/presence")
+async def get_presence(
+    user_ids: List[str] = Query([]),
+    current_user: dict = Depends(get_current_user_role)
+):
+    """Get users' online status from the in-memory presence registry"""
+    return {user_id: presence.is_online(user_id) for user_id in user_ids[:200]}
+
 @api_router.get("/students")
-async def get_students(current_user: dict = Depends(get_current_user)):
-    """Get list of all students for chat user lookup"""
+async def get_students(
+    search: Optional[str] = Query(None),
+    after: Optional[str] = Query(None),
+    limit: int = Query(50, ge=1, le=100),
+    current_user: dict = Depends(get_current_user_role)
+):
+    """Get the student directory for chat user lookup, ordered by name.
+    
+    `search` is a case-insensitive prefix of the name or location; `after` is the
+    id of the last student of the previous page.
+    """
     if current_user["role"] != "student":
         raise HTTPException(status_code=403, detail="Only students can view other students")
     
-    # Get all students except current user
-    students = await db.users.find({
-        "role": "student",
-        "id": {"$ne": current_user["id"]}
-    }).to_list(100)
+    # Anchored prefixes on the lowercased fields are served from the role/name and role/location indexes
+    conditions = [{"role": "student", "id": {"$ne": current_user["id"]}, "is_active": {"$ne": False}}]
+    if search and search.strip():
+        prefix = f"^{re.escape(search.strip().lower())}"
+        conditions.append({"$or": [
+            {"name_lower": {"$regex": prefix}},
+            {"location_lower": {"$regex": prefix}}
+        ]})
+    
+    if after:
+        cursor = await db.users.find_one({"id": after}, {"id": 1, "name_lower": 1})
+        if not cursor:
+            raise HTTPException(status_code=404, detail="Cursor student not found")
+        conditions.append({"$or": [
+            {"name_lower": {"$gt": cursor["name_lower"]}},
+            {"name_lower": cursor["name_lower"], "id": {"$gt": cursor["id"]}}
+        ]})
+    
+    students = await db.users.find(
+        {"$and": conditions},
+        {"_id": 0, "id": 1, "name": 1, "location": 1, "bio": 1, "profile_image": 1}
+    ).sort([("name_lower", 1), ("id", 1)]).limit(limit).to_list(limit)
     
     # Return only safe user info
     return [
@@ -1662,80 +3206,291 @@ async def get_students(current_user: dict = Depends(get_current_user)):
 @api_router.post("/messages/{message_id}/read")
 async def mark_message_read(message_id: str, current_user: dict = Depends(get_current_user)):
     """Mark a message as read"""
-    result = await db.messages.update_one(
-        {"id": message_id, "receiver_id": current_user["id"]},
-        {"$set": {"is_read": True}}
-    )
+    if MESSAGE_STORAGE == "bucket":
+        message_filter = {"id": message_id, "sender_id": {"$ne": current_user["id"]}}
+        bucket = await db.message_buckets.find_one(
+            {"participants": current_user["id"], "messages": {"$elemMatch": message_filter}},
+            {"conversation_id": 1, "messages": {"$elemMatch": message_filter}}
+        )
+        if not bucket:
+            raise HTTPException(status_code=404, detail="Message not found")
+        
+        marked_read = await update_bucket_messages(
+            {"conversation_id": bucket["conversation_id"]},
+            {**message_filter, "is_read": False},
+            {"is_read": True}
+        )
+        conversation_id = bucket["conversation_id"]
+    else:
+        message = await db.messages.find_one_and_update(
+            {"id": message_id, "receiver_id": current_user["id"]},
+            {"$set": {"is_read": True}},
+            projection={"conversation_id": 1, "is_read": 1},
+            return_document=ReturnDocument.BEFORE
+        )
+        if not message:
+            raise HTTPException(status_code=404, detail="Message not found")
+        
+        marked_read = 0 if message.get("is_read") else 1
+        conversation_id = message["conversation_id"]
     
-    if result.matched_count == 0:
-        raise HTTPException(status_code=404, detail="Message not found")
+    if marked_read:
+        await decrement_unread_count(conversation_id, current_user["id"], marked_read)
     
     return {"message": "Message marked as read"}
 
 # --- ADMIN ENDPOINTS ---
 
+# Fields never returned to admins; everything else on the user document is
+ADMIN_USER_PROJECTION = {"_id": 0, "password": 0, "name_lower": 0, "location_lower": 0}
+ADMIN_USER_EXPORT_FIELDS = list(User.model_fields)
+ADMIN_USER_EXPORT_BATCH_SIZE = 1000
+
+def admin_user_query(role: Optional[str], is_active: Optional[bool]) -> dict:
+    query = {}
+    if role:
+        query["role"] = role
+    if is_active is not None:
+        query["is_active"] = is_active
+    return query
+
 @api_router.get("/admin/users")
-async def get_all_users(admin_user: dict = Depends(get_admin_user)):
-    """Get all users for admin management"""
-    users = await db.users.find({}).to_list(1000)
-    
-    # Remove password and convert ObjectId to string
-    safe_users = []
-    for user in users:
-        safe_user = {k: v for k, v in user.items() if k not in ["password", "_id"]}
-        safe_users.append(safe_user)
+async def get_all_users(
+    role: Optional[str] = None,
+    is_active: Optional[bool] = None,
+    after: Optional[str] = Query(None, description="Last user id of the previous page"),
+    limit: int = Query(1000, ge=1, le=1000),
+    admin_user: dict = Depends(get_admin_user)
+):
+    """Get users for admin management, ordered by id; page with `after`"""
+    query = admin_user_query(role, is_active)
+    if after:
+        query["id"] = {"$gt": after}
     
-    return safe_users
+    return await db.users.find(query, ADMIN_USER_PROJECTION).sort("id", 1).limit(limit).to_list(limit)
 
-@api_router.get("/admin/stats")
-async def get_admin_stats(admin_user: dict = Depends(get_admin_user)):
-    """Get platform statistics for admin dashboard"""
-    try:
-        # Count users by role
-        total_users = await db.users.count_documents({})
-        total_students = await db.users.count_documents({"role": "student"})
-        total_libraries = await db.users.count_documents({"role": "library"})
-        active_users = await db.users.count_documents({"is_active": True})
-        
-        # Count content
-        total_books = await db.books.count_documents({})
-        total_competitions = await db.competitions.count_documents({})
-        total_messages = await db.messages.count_documents({})
-        total_bookings = await db.bookings.count_documents({})
-        
-        # Count subscriptions
-        active_subscriptions = await db.library_subscriptions.count_documents({
+@api_router.get("/admin/users/export")
+async def export_users(
+    format: str = Query("ndjson", pattern="^(ndjson|csv)$"),
+    role: Optional[str] = None,
+    is_active: Optional[bool] = None,
+    admin_user: dict = Depends(get_admin_user)
+):
+    """Stream every matching user as NDJSON or CSV, reading the cursor in batches"""
+    cursor = db.users.find(
+        admin_user_query(role, is_active), ADMIN_USER_PROJECTION
+    ).sort("id", 1).batch_size(ADMIN_USER_EXPORT_BATCH_SIZE)
+    
+    async def ndjson_rows():
+        async for user in cursor:
+            yield json.dumps(jsonable_encoder(user)) + "\n"
+    
+    async def csv_rows():
+        buffer = io.StringIO()
+        writer = csv.DictWriter(buffer, fieldnames=ADMIN_USER_EXPORT_FIELDS, extrasaction="ignore")
+        writer.writeheader()
+        async for user in cursor:
+            writer.writerow(jsonable_encoder(user))
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+    
+    if format == "csv":
+        return StreamingResponse(csv_rows(), media_type="text/csv", headers={
+            "Content-Disposition": "attachment; filename=users.csv"
+        })
+    return StreamingResponse(ndjson_rows(), media_type="application/x-ndjson", headers={
+        "Content-Disposition": "attachment; filename=users.ndjson"
+    })
+
+# Dashboard auto-refresh hits the stats every few seconds; serve them from memory for this long
+ADMIN_STATS_CACHE_TTL = float(os.environ.get('ADMIN_STATS_CACHE_TTL', '10'))
+admin_stats_cache = {"expires_at": 0.0, "stats": None}
+admin_stats_lock = asyncio.Lock()
+
+async def count_users_by_role() -> dict:
+    """Total and active user counts per role in a single pass over users"""
+    groups = await db.users.aggregate([
+        {"$group": {
+            "_id": "$role",
+            "total": {"$sum": 1},
+            "active": {"$sum": {"$cond": [{"$eq": ["$is_active", True]}, 1, 0]}}
+        }}
+    ]).to_list(None)
+    return {group["_id"]: group for group in groups}
+
+async def count_messages() -> int:
+    if MESSAGE_STORAGE == "bucket":
+        result = await db.message_buckets.aggregate([
+            {"$group": {"_id": None, "count": {"$sum": "$count"}}}
+        ]).to_list(1)
+        return result[0]["count"] if result else 0
+    return await db.messages.count_documents({})
+
+async def compute_admin_stats() -> dict:
+    (
+        users_by_role,
+        total_books,
+        total_competitions,
+        total_messages,
+        total_bookings,
+        active_subscriptions,
+        trial_subscriptions
+    ) = await asyncio.gather(
+        count_users_by_role(),
+        db.books.count_documents({}),
+        db.competitions.count_documents({}),
+        count_messages(),
+        db.bookings.count_documents({}),
+        db.library_subscriptions.count_documents({
             "status": "active",
             "end_date": {"$gt": datetime.now(timezone.utc)}
-        })
-        trial_subscriptions = await db.library_subscriptions.count_documents({
+        }),
+        db.library_subscriptions.count_documents({
             "is_trial": True,
             "status": "active"
         })
-        
-        return {
-            "users": {
-                "total": total_users,
-                "students": total_students,
-                "libraries": total_libraries,
-                "active": active_users,
-                "inactive": total_users - active_users
-            },
-            "content": {
-                "books": total_books,
-                "competitions": total_competitions,
-                "messages": total_messages,
-                "bookings": total_bookings
-            },
-            "subscriptions": {
-                "active": active_subscriptions,
-                "trial": trial_subscriptions,
-                "paid": active_subscriptions - trial_subscriptions
-            }
+    )
+    
+    total_users = sum(group["total"] for group in users_by_role.values())
+    active_users = sum(group["active"] for group in users_by_role.values())
+    
+    return {
+        "users": {
+            "total": total_users,
+            "students": users_by_role.get("student", {}).get("total", 0),
+            "libraries": users_by_role.get("library", {}).get("total", 0),
+            "active": active_users,
+            "inactive": total_users - active_users
+        },
+        "content": {
+            "books": total_books,
+            "competitions": total_competitions,
+            "messages": total_messages,
+            "bookings": total_bookings
+        },
+        "subscriptions": {
+            "active": active_subscriptions,
+            "trial": trial_subscriptions,
+            "paid": active_subscriptions - trial_subscriptions
         }
+    }
+
+@api_router.get("/admin/stats")
+async def get_admin_stats(admin_user: dict = Depends(get_admin_user)):
+    """Get platform statistics for admin dashboard"""
+    try:
+        # Concurrent dashboards wait for one refresh instead of each running the counts
+        async with admin_stats_lock:
+            if admin_stats_cache["expires_at"] < time.monotonic():
+                admin_stats_cache["stats"] = await compute_admin_stats()
+                admin_stats_cache["expires_at"] = time.monotonic() + ADMIN_STATS_CACHE_TTL
+            return admin_stats_cache["stats"]
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to fetch admin stats: {str(e)}")
 
+def deleted_user_fields(user_id: str, location: str) -> dict:
+    """Soft delete - mark as inactive and anonymize data"""
+    return {
+        "is_active": False,
+        "name": "Deleted User",
+        "email": f"deleted_{user_id}@uninest.local",
+        "bio": "User account deleted",
+        **user_search_fields("Deleted User", location)
+    }
+
+# Deleted users' content is removed by a background cascade, in batches
+USER_CLEANUP_INTERVAL = timedelta(minutes=int(os.environ.get('USER_CLEANUP_INTERVAL_MINUTES', '5')))
+USER_CLEANUP_BATCH_SIZE = 500
+
+async def enqueue_user_cleanup(user_ids: List[str]):
+    if user_ids:
+        await db.user_cleanup_jobs.bulk_write([
+            UpdateOne(
+                {"user_id": user_id},
+                {"$setOnInsert": UserCleanupJob(user_id=user_id).dict()},
+                upsert=True
+            )
+            for user_id in user_ids
+        ], ordered=False)
+
+async def record_cleanup_progress(user_id: str, step: str, count: int):
+    await db.user_cleanup_jobs.update_one({"user_id": user_id}, {"$inc": {f"progress.{step}": count}})
+
+async def cleanup_in_batches(user_id: str, step: str, collection, query: dict, handle_batch):
+    """Feed the ids matching query to handle_batch a batch at a time until none are left"""
+    while True:
+        batch = await collection.find(query, {"_id": 0}).limit(USER_CLEANUP_BATCH_SIZE).to_list(USER_CLEANUP_BATCH_SIZE)
+        if not batch:
+            return
+        await handle_batch(batch)
+        await record_cleanup_progress(user_id, step, len(batch))
+
+async def cleanup_deleted_user(user_id: str):
+    """Remove a deleted user's listings, notes and posts, cancel their upcoming bookings
+    and withdraw them from competitions that are still running"""
+    async def delete_books(books):
+        await db.books.delete_many({"id": {"$in": [book["id"] for book in books]}})
+    await cleanup_in_batches(user_id, "books", db.books, {"seller_id": user_id}, delete_books)
+    
+    async def delete_notes(notes):
+        await db.notes.delete_many({"id": {"$in": [note["id"] for note in notes]}})
+    await cleanup_in_batches(user_id, "notes", db.notes, {"uploader_id": user_id}, delete_notes)
+    
+    async def delete_posts(posts):
+        post_ids = [post["id"] for post in posts]
+        await db.post_likes.delete_many({"post_id": {"$in": post_ids}})
+        await db.post_comments.delete_many({"post_id": {"$in": post_ids}})
+        await db.feed_timelines.update_many(
+            {},
+            {"$pull": {"entries": {"post_id": {"$in": post_ids}}, "heavy_posters": user_id}}
+        )
+        await db.posts.delete_many({"id": {"$in": post_ids}})
+    await cleanup_in_batches(user_id, "posts", db.posts, {"creator_id": user_id}, delete_posts)
+    
+    async def cancel_bookings(bookings):
+        # Seats go back only for bookings this call cancelled, never twice for the same booking
+        cancelled = []
+        for booking in bookings:
+            result = await db.bookings.update_one(
+                {"id": booking["id"], "status": "confirmed"},
+                {"$set": {"status": "cancelled"}}
+            )
+            if result.modified_count:
+                cancelled.append(booking)
+        if cancelled:
+            await db.time_slots.bulk_write([
+                UpdateOne({"id": booking["time_slot_id"]}, {"$inc": {"booked_seats": -booking.get("seats_booked", 1)}})
+                for booking in cancelled
+            ], ordered=False)
+    today = datetime.now(timezone.utc).strftime("%Y-%m-%d")
+    await cleanup_in_batches(
+        user_id, "bookings", db.bookings,
+        {"student_id": user_id, "status": "confirmed", "date": {"$gte": today}},
+        cancel_bookings
+    )
+    
+    # Registrations in finished competitions are kept as results/payment history
+    active_competition_ids = await db.competitions.distinct("id", {"status": "active"})
+    async def delete_registrations(registrations):
+        await db.competition_registrations.delete_many({"id": {"$in": [registration["id"] for registration in registrations]}})
+    await cleanup_in_batches(
+        user_id, "registrations", db.competition_registrations,
+        {"student_id": user_id, "competition_id": {"$in": active_competition_ids}},
+        delete_registrations
+    )
+
+async def run_user_cleanup():
+    """Work through pending cleanup jobs; interrupted ("running") jobs are resumed"""
+    async for job in db.user_cleanup_jobs.find({"status": {"$in": ["pending", "running"]}}).sort("created_at", 1):
+        await db.user_cleanup_jobs.update_one({"user_id": job["user_id"]}, {"$set": {"status": "running"}})
+        await cleanup_deleted_user(job["user_id"])
+        await db.user_cleanup_jobs.update_one(
+            {"user_id": job["user_id"]},
+            {"$set": {"status": "completed", "completed_at": datetime.now(timezone.utc)}}
+        )
+
 @api_router.post("/admin/users/{user_id}/manage")
 async def manage_user(
     user_id: str,
@@ -1759,13 +3514,15 @@ async def manage_user(
         target_type="user",
         reason=action_data.reason or f"User {action_data.action}"
     )
-    await db.admin_actions.insert_one(admin_action.dict())
+    await audit_writer.log(admin_action)
     
     if action_data.action == "suspend":
         await db.users.update_one(
             {"id": user_id},
             {"$set": {"is_active": False}}
         )
+        # Invalidate after the write so a concurrent lookup can't re-cache the old status
+        await invalidate_user_roles([user_id])
         return {"message": f"User {target_user['name']} suspended successfully"}
     
     elif action_data.action == "activate":
@@ -1773,33 +3530,111 @@ async def manage_user(
             {"id": user_id},
             {"$set": {"is_active": True}}
         )
+        await invalidate_user_roles([user_id])
         return {"message": f"User {target_user['name']} activated successfully"}
     
     elif action_data.action == "delete":
         # Soft delete - mark as inactive and anonymize data
         await db.users.update_one(
             {"id": user_id},
-            {"$set": {
-                "is_active": False,
-                "name": "Deleted User",
-                "email": f"deleted_{user_id}@uninest.local",
-                "bio": "User account deleted"
-            }}
+            {"$set": deleted_user_fields(user_id, target_user.get("location", ""))}
         )
+        await invalidate_user_roles([user_id])
+        await enqueue_user_cleanup([user_id])
         return {"message": f"User {target_user['name']} deleted successfully"}
     
     else:
         raise HTTPException(status_code=400, detail="Invalid action")
 
+# Bulk moderation: ids per request, and per bulk_write batch
+ADMIN_BULK_MAX_IDS = int(os.environ.get('ADMIN_BULK_MAX_IDS', '10000'))
+ADMIN_BULK_BATCH_SIZE = 1000
+
+def bulk_id_batches(ids: List[str]):
+    ids = list(dict.fromkeys(ids))
+    if len(ids) > ADMIN_BULK_MAX_IDS:
+        raise HTTPException(status_code=400, detail=f"At most {ADMIN_BULK_MAX_IDS} ids per request")
+    for start in range(0, len(ids), ADMIN_BULK_BATCH_SIZE):
+        yield ids[start:start + ADMIN_BULK_BATCH_SIZE]
+
+@api_router.post("/admin/users/bulk-manage")
+async def bulk_manage_users(action_data: BulkUserManagementAction, admin_user: dict = Depends(get_admin_user)):
+    """Suspend, activate or delete many users at once, logged as one admin action"""
+    if action_data.action not in ("suspend", "activate", "delete"):
+        raise HTTPException(status_code=400, detail="Invalid action")
+    
+    affected_ids = []
+    for batch in bulk_id_batches(action_data.user_ids):
+        # Admins can't be modified, missing ids are skipped
+        targets = await db.users.find(
+            {"id": {"$in": batch}, "role": {"$ne": "admin"}},
+            {"_id": 0, "id": 1, "location": 1}
+        ).to_list(len(batch))
+        if not targets:
+            continue
+        
+        if action_data.action == "delete":
+            await db.users.bulk_write([
+                UpdateOne({"id": user["id"]}, {"$set": deleted_user_fields(user["id"], user.get("location", ""))})
+                for user in targets
+            ], ordered=False)
+        else:
+            await db.users.bulk_write([
+                UpdateOne({"id": user["id"]}, {"$set": {"is_active": action_data.action == "activate"}})
+                for user in targets
+            ], ordered=False)
+        
+        await invalidate_user_roles([user["id"] for user in targets])
+        affected_ids.extend(user["id"] for user in targets)
+        if action_data.action == "delete":
+            await enqueue_user_cleanup([user["id"] for user in targets])
+    
+    if affected_ids:
+        await audit_writer.log(AdminAction(
+            admin_id=admin_user["id"],
+            action_type=f"user_bulk_{action_data.action}",
+            target_id="bulk",
+            target_type="user",
+            target_ids=affected_ids,
+            reason=action_data.reason or f"Bulk user {action_data.action}"
+        ))
+    
+    return {"message": f"{len(affected_ids)} users updated", "affected": len(affected_ids)}
+
 @api_router.get("/admin/content/books")
-async def get_all_books_admin(admin_user: dict = Depends(get_admin_user)):
-    """Get all books for content moderation"""
-    books = await db.books.find({}).to_list(1000)
+async def get_all_books_admin(
+    flagged: bool = Query(False, description="Only listings left by suspended or deleted sellers"),
+    since: Optional[datetime] = Query(None, description="Only books listed after this time"),
+    before: Optional[datetime] = Query(None, description="created_at of the last book on the previous page"),
+    limit: int = Query(1000, ge=1, le=1000),
+    admin_user: dict = Depends(get_admin_user)
+):
+    """Get books for content moderation, newest first"""
+    query = {}
+    if since or before:
+        query["created_at"] = {}
+        if since:
+            query["created_at"]["$gt"] = since
+        if before:
+            query["created_at"]["$lt"] = before
+    if flagged:
+        query["seller_id"] = {"$in": await db.users.distinct("id", {"is_active": False})}
+    
+    books = await db.books.find(query).sort("created_at", -1).limit(limit).to_list(limit)
+    
+    # Enrich with seller information fetched in one query
+    seller_ids = list({book["seller_id"] for book in books})
+    sellers = {
+        user["id"]: user
+        for user in await db.users.find(
+            {"id": {"$in": seller_ids}},
+            {"_id": 0, "id": 1, "name": 1, "email": 1}
+        ).to_list(len(seller_ids))
+    }
     
-    # Enrich with user information
     enriched_books = []
     for book in books:
-        user = await db.users.find_one({"id": book["seller_id"]})
+        user = sellers.get(book["seller_id"])
         book_data = Book(**book)
         enriched_books.append({
             "book": book_data,
@@ -1827,29 +3662,253 @@ async def delete_book_admin(book_id: str, admin_user: dict = Depends(get_admin_u
         target_type="book",
         reason="Admin moderation"
     )
-    await db.admin_actions.insert_one(admin_action.dict())
+    await audit_writer.log(admin_action)
     
     # Delete the book
     await db.books.delete_one({"id": book_id})
     
     return {"message": "Book deleted successfully"}
 
+@api_router.get("/admin/cleanup-jobs", response_model=List[UserCleanupJob])
+async def get_cleanup_jobs(
+    status: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=500),
+    admin_user: dict = Depends(get_admin_user)
+):
+    """Progress of deleted-user cleanup jobs, newest first"""
+    query = {"status": status} if status else {}
+    jobs = await db.user_cleanup_jobs.find(query).sort("created_at", -1).limit(limit).to_list(limit)
+    return [UserCleanupJob(**job) for job in jobs]
+
+@api_router.post("/admin/content/books/bulk-delete")
+async def bulk_delete_books_admin(removal: BulkContentRemoval, admin_user: dict = Depends(get_admin_user)):
+    """Delete many books at once, logged as one admin action"""
+    removed_ids = []
+    for batch in bulk_id_batches(removal.book_ids):
+        existing = await db.books.distinct("id", {"id": {"$in": batch}})
+        if existing:
+            await db.books.delete_many({"id": {"$in": existing}})
+            removed_ids.extend(existing)
+    
+    if removed_ids:
+        await audit_writer.log(AdminAction(
+            admin_id=admin_user["id"],
+            action_type="content_bulk_delete",
+            target_id="bulk",
+            target_type="book",
+            target_ids=removed_ids,
+            reason=removal.reason or "Admin moderation"
+        ))
+    
+    return {"message": f"{len(removed_ids)} books deleted", "deleted": len(removed_ids)}
+
+class AdminNameCache:
+    """Admin id -> name. There are only a handful of admins and they change rarely,
+    so all of them are loaded with one query, again after the TTL or on an unknown id.
+    
+    Ids still unknown after a reload (deleted or demoted admins) are remembered until
+    the TTL runs out, so their past actions don't force a reload on every request.
+    """
+    
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self.expires_at = 0.0
+        self.names: Dict[str, str] = {}
+        self.missing: Set[str] = set()
+    
+    async def get_many(self, admin_ids: List[str]) -> Dict[str, str]:
+        unknown = {admin_id for admin_id in admin_ids if admin_id not in self.names} - self.missing
+        if self.expires_at < time.monotonic() or unknown:
+            admins = await db.users.find({"role": "admin"}, {"_id": 0, "id": 1, "name": 1}).to_list(None)
+            self.names = {admin["id"]: admin["name"] for admin in admins}
+            self.missing = (self.missing | set(admin_ids)) - self.names.keys()
+            self.expires_at = time.monotonic() + self.ttl
+        return self.names
+
+admin_name_cache = AdminNameCache(ttl=float(os.environ.get('ADMIN_NAME_CACHE_TTL', '3600')))
+
 @api_router.get("/admin/actions")
-async def get_admin_actions(admin_user: dict = Depends(get_admin_user)):
-    """Get recent admin actions for audit trail"""
-    actions = await db.admin_actions.find({}).sort("created_at", -1).limit(100).to_list(100)
-    
-    # Enrich with admin and target information
-    enriched_actions = []
-    for action in actions:
-        admin = await db.users.find_one({"id": action["admin_id"]})
-        action_data = AdminAction(**action)
-        enriched_actions.append({
-            "action": action_data,
-            "admin_name": admin["name"] if admin else "Unknown Admin"
-        })
+async def get_admin_actions(
+    action_type: Optional[str] = None,
+    target_type: Optional[str] = None,
+    since: Optional[datetime] = Query(None, description="Only actions at or after this time"),
+    until: Optional[datetime] = Query(None, description="Only actions before this time"),
+    before: Optional[datetime] = Query(None, description="created_at of the last action on the previous page"),
+    limit: int = Query(100, ge=1, le=500),
+    admin_user: dict = Depends(get_admin_user)
+):
+    """Get admin actions for audit trail, newest first"""
+    # Include this worker's buffered entries
+    await audit_writer.flush()
+    
+    query = {}
+    if action_type:
+        query["action_type"] = action_type
+    if target_type:
+        query["target_type"] = target_type
+    if since or until or before:
+        query["created_at"] = {}
+        if since:
+            query["created_at"]["$gte"] = since
+        if until or before:
+            query["created_at"]["$lt"] = min(to_naive_utc(bound) for bound in (until, before) if bound)
+    
+    actions = await db.admin_actions.find(query).sort("created_at", -1).limit(limit).to_list(limit)
+    
+    # Enrich with admin information
+    admin_names = await admin_name_cache.get_many(list({action["admin_id"] for action in actions}))
+    return [
+        {
+            "action": AdminAction(**action),
+            "admin_name": admin_names.get(action["admin_id"], "Unknown Admin")
+        }
+        for action in actions
+    ]
+
+@api_router.get("/admin/rate-limits")
+async def get_rate_limits(admin_user: dict = Depends(get_admin_user)):
+    """Rate limit budgets and this worker's allowed/limited counters"""
+    return rate_limiter.snapshot()
+
+# --- PLATFORM METRICS ---
+
+# Days rolled up on first run; afterwards each run fills in the days since the last rollup
+METRICS_BACKFILL_DAYS = int(os.environ.get('METRICS_BACKFILL_DAYS', '90'))
+METRICS_MAX_RANGE_DAYS = 366
+
+async def create_metrics_collection():
+    """Store daily rollups in a time-series collection where the server supports them (MongoDB 5.0+)"""
+    if "daily_metrics" in await db.list_collection_names():
+        return
+    try:
+        await db.create_collection("daily_metrics", timeseries={"timeField": "day", "granularity": "hours"})
+    except OperationFailure:
+        logger.warning("Time-series collections unsupported, daily_metrics is a regular collection")
+        await db.daily_metrics.create_index("day")
+
+async def group_counts(collection, match: dict, key: str, total: Any = 1) -> Dict[str, int]:
+    groups = await collection.aggregate([
+        {"$match": match},
+        {"$group": {"_id": f"${key}", "total": {"$sum": total}}}
+    ]).to_list(None)
+    return {str(group["_id"]): group["total"] for group in groups}
+
+async def compute_daily_metrics(day: datetime) -> DailyMetrics:
+    """Roll one UTC day of raw signups, bookings, registrations and payments into a DailyMetrics"""
+    in_day = {"$gte": day, "$lt": day + timedelta(days=1)}
+    
+    signups, bookings, booked_seats, registrations, ledger_day = await asyncio.gather(
+        group_counts(db.users, {"created_at": in_day}, "role"),
+        group_counts(db.bookings, {"created_at": in_day}, "library_id"),
+        group_counts(db.bookings, {"created_at": in_day}, "library_id", total="$seats_booked"),
+        group_counts(db.competition_registrations, {"registration_date": in_day}, "payment_status"),
+        db.ledger_daily.find_one({"day": day.strftime("%Y-%m-%d")})
+    )
     
-    return enriched_actions
+    revenue_by_type = (ledger_day or {}).get("by_type", {})
+    return DailyMetrics(
+        day=day,
+        signups=signups,
+        bookings=bookings,
+        booked_seats=booked_seats,
+        registrations=registrations,
+        revenue={
+            "subscriptions": revenue_by_type.get("subscription", 0),
+            "competitions": revenue_by_type.get("competition_entry", 0)
+        }
+    )
+
+async def run_metrics_rollup() -> int:
+    """Roll up every finished day since the last rollup, returning how many days were written"""
+    today = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    latest = await db.daily_metrics.find_one({}, {"day": 1}, sort=[("day", -1)])
+    if latest:
+        day = latest["day"].replace(tzinfo=timezone.utc) + timedelta(days=1)
+    else:
+        day = today - timedelta(days=METRICS_BACKFILL_DAYS)
+    
+    rolled = 0
+    while day < today:
+        metrics = await compute_daily_metrics(day)
+        await db.daily_metrics.insert_one(metrics.dict())
+        day += timedelta(days=1)
+        rolled += 1
+    return rolled
+
+def metrics_range_query(start: date, end: date) -> dict:
+    if end < start:
+        raise HTTPException(status_code=400, detail="end must not be before start")
+    if (end - start).days > METRICS_MAX_RANGE_DAYS:
+        raise HTTPException(status_code=400, detail=f"Range is limited to {METRICS_MAX_RANGE_DAYS} days")
+    return {"day": {
+        "$gte": datetime.combine(start, datetime.min.time(), tzinfo=timezone.utc),
+        "$lte": datetime.combine(end, datetime.min.time(), tzinfo=timezone.utc)
+    }}
+
+@api_router.get("/admin/metrics/daily", response_model=List[DailyMetrics])
+async def get_daily_metrics(
+    start: date = Query(..., description="First day (UTC) to include"),
+    end: date = Query(..., description="Last day (UTC) to include"),
+    admin_user: dict = Depends(get_admin_user)
+):
+    """Per-day platform metrics from the daily rollup; today is available tomorrow"""
+    days = await db.daily_metrics.find(metrics_range_query(start, end), {"_id": 0}).sort("day", 1).to_list(METRICS_MAX_RANGE_DAYS + 1)
+    return [DailyMetrics(**day) for day in days]
+
+@api_router.get("/admin/metrics/summary")
+async def get_metrics_summary(
+    start: date = Query(..., description="First day (UTC) to include"),
+    end: date = Query(..., description="Last day (UTC) to include"),
+    admin_user: dict = Depends(get_admin_user)
+):
+    """Platform metrics summed over a date range of daily rollups"""
+    summary = {"days": 0, "signups": {}, "bookings": {}, "booked_seats": {}, "registrations": {}, "revenue": {}}
+    async for day in db.daily_metrics.find(metrics_range_query(start, end), {"_id": 0, "day": 0}):
+        summary["days"] += 1
+        for field, counts in day.items():
+            for key, value in counts.items():
+                summary[field][key] = summary[field].get(key, 0) + value
+    return summary
+
+@api_router.get("/admin/finance/daily")
+async def get_finance_daily(
+    start: date = Query(..., description="First day (UTC) to include"),
+    end: date = Query(..., description="Last day (UTC) to include"),
+    admin_user: dict = Depends(get_admin_user)
+):
+    """Revenue per day from the ledger's running totals, with a cumulative total over the range"""
+    metrics_range_query(start, end)  # validates the range
+    days = await db.ledger_daily.find(
+        {"day": {"$gte": start.isoformat(), "$lte": end.isoformat()}}, {"_id": 0}
+    ).sort("day", 1).to_list(METRICS_MAX_RANGE_DAYS + 1)
+    
+    running_total = 0
+    for day in days:
+        running_total += day["total"]
+        day["running_total"] = running_total
+    return {"days": days, "total": running_total}
+
+@api_router.get("/admin/finance/ledger", response_model=List[LedgerEntry])
+async def get_ledger_entries(
+    start: Optional[datetime] = Query(None, description="Only entries at or after this time"),
+    before: Optional[datetime] = Query(None, description="created_at of the last entry on the previous page"),
+    entry_type: Optional[str] = None,
+    limit: int = Query(100, ge=1, le=1000),
+    admin_user: dict = Depends(get_admin_user)
+):
+    """Ledger entries, newest first"""
+    query = {}
+    if entry_type:
+        query["entry_type"] = entry_type
+    if start or before:
+        query["created_at"] = {}
+        if start:
+            query["created_at"]["$gte"] = start
+        if before:
+            query["created_at"]["$lt"] = before
+    
+    entries = await db.ledger.find(query).sort("created_at", -1).limit(limit).to_list(limit)
+    return [LedgerEntry(**entry) for entry in entries]
 
 # --- BASIC ENDPOINTS ---
 
@@ -1871,6 +3930,35 @@ app.mount("/socket.io", socketio.ASGIApp(sio))
 @app.on_event("startup")
 async def startup_event():
     await initialize_admin()
+    await migrate_archive_buckets()
+    await migrate_message_buckets()
+    await create_indexes()
+    await create_metrics_collection()
+    await migrate_embedded_post_likes()
+    await migrate_embedded_post_comments()
+    await backfill_message_conversation_ids()
+    await backfill_chat_rooms()
+    await backfill_user_search_fields()
+    await backfill_post_locations()
+    await backfill_ledger()
+    
+    # Background maintenance jobs
+    background_tasks.append(asyncio.create_task(
+        run_periodically("archive_messages", timedelta(hours=24), archive_old_messages)
+    ))
+    background_tasks.append(asyncio.create_task(
+        run_periodically("prune_heavy_posters", timedelta(minutes=15), prune_heavy_posters)
+    ))
+    background_tasks.append(asyncio.create_task(
+        run_periodically("user_cleanup", USER_CLEANUP_INTERVAL, run_user_cleanup)
+    ))
+    background_tasks.append(asyncio.create_task(
+        run_periodically("metrics_rollup", timedelta(hours=1), run_metrics_rollup)
+    ))
+    background_tasks.append(asyncio.create_task(
+        run_periodically("library_analytics", LIBRARY_ANALYTICS_INTERVAL, run_library_analytics)
+    ))
+    background_tasks.append(asyncio.create_task(run_presence_maintenance()))
 
 # CORS middleware
 app.add_middleware(
@@ -1890,20 +3978,256 @@ logger = logging.getLogger(__name__)
 
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    for task in background_tasks:
+        task.cancel()
+    await post_emitter.flush()
+    await audit_writer.close()
     client.close()
 
 # --- SOCKET.IO EVENTS ---
 
+# Presence: a session goes offline after PRESENCE_TIMEOUT seconds without a heartbeat;
+# workers publish their online users every PRESENCE_SYNC_INTERVAL seconds
+PRESENCE_TIMEOUT = float(os.environ.get('PRESENCE_TIMEOUT', '60'))
+PRESENCE_SYNC_INTERVAL = float(os.environ.get('PRESENCE_SYNC_INTERVAL', '10'))
+
+class PresenceRegistry:
+    """In-memory online status, never persisted.
+    
+    Each worker tracks its own socket sessions and keeps the latest snapshot of
+    online users published by every other worker; snapshots from a worker that
+    stops publishing expire after three sync intervals.
+    """
+    
+    def __init__(self, timeout: float, sync_interval: float):
+        self.host_id = uuid.uuid4().hex
+        self.timeout = timeout
+        self.sync_interval = sync_interval
+        self.session_users: Dict[str, str] = {}  # sid -> user ID
+        self.last_heartbeat: Dict[str, float] = {}  # sid -> monotonic time
+        self.user_sessions: Dict[str, set] = {}  # user ID -> local sids
+        self.remote_hosts: Dict[str, tuple] = {}  # host ID -> (received at, user IDs)
+    
+    def is_online(self, user_id: str) -> bool:
+        if self.user_sessions.get(user_id):
+            return True
+        stale_before = time.monotonic() - 3 * self.sync_interval
+        return any(
+            user_id in users
+            for received_at, users in self.remote_hosts.values()
+            if received_at >= stale_before
+        )
+    
+    def touch(self, sid: str, user_id: str):
+        """Register a session or refresh its heartbeat"""
+        self.session_users[sid] = user_id
+        self.last_heartbeat[sid] = time.monotonic()
+        self.user_sessions.setdefault(user_id, set()).add(sid)
+    
+    def remove(self, sid: str) -> Optional[str]:
+        """Drop a session, returning its user ID"""
+        user_id = self.session_users.pop(sid, None)
+        self.last_heartbeat.pop(sid, None)
+        if user_id is not None:
+            sessions = self.user_sessions.get(user_id, set())
+            sessions.discard(sid)
+            if not sessions:
+                self.user_sessions.pop(user_id, None)
+        return user_id
+    
+    def expire(self) -> List[str]:
+        """Drop sessions that stopped heartbeating and stale remote snapshots, returning affected users"""
+        now = time.monotonic()
+        expired_sids = [sid for sid, seen in self.last_heartbeat.items() if seen < now - self.timeout]
+        users = {self.remove(sid) for sid in expired_sids}
+        
+        stale_before = now - 3 * self.sync_interval
+        for host_id, (received_at, _) in list(self.remote_hosts.items()):
+            if received_at < stale_before:
+                del self.remote_hosts[host_id]
+        return [user_id for user_id in users if user_id is not None]
+    
+    def apply_sync(self, host_id: str, users: List[str]):
+        if host_id != self.host_id:
+            self.remote_hosts[host_id] = (time.monotonic(), set(users))
+    
+    def snapshot(self) -> Dict[str, Any]:
+        return {"host_id": self.host_id, "users": list(self.user_sessions)}
+
+presence = PresenceRegistry(PRESENCE_TIMEOUT, PRESENCE_SYNC_INTERVAL)
+
+def get_presence_room(user_id: str) -> str:
+    """Socket.IO room of the sessions watching a user's online status"""
+    return f"presence:{user_id}"
+
+async def emit_presence(user_id: str, online: bool):
+    await sio.emit('presence', {"user_id": user_id, "online": online}, room=get_presence_room(user_id))
+
+async def touch_presence(sid: str, user_id: str):
+    was_online = presence.is_online(user_id)
+    presence.touch(sid, user_id)
+    if not was_online:
+        await emit_presence(user_id, True)
+
+async def run_presence_maintenance():
+    """Expire silent sessions and publish this worker's online users to the others"""
+    while True:
+        await asyncio.sleep(PRESENCE_SYNC_INTERVAL)
+        try:
+            for user_id in presence.expire():
+                if not presence.is_online(user_id):
+                    await emit_presence(user_id, False)
+            if isinstance(sio.manager, AsyncPubSubManager):
+                await sio.emit(PRESENCE_SYNC_EVENT, presence.snapshot(), room=PRESENCE_SYNC_ROOM)
+        except Exception:
+            logger.exception("Presence maintenance failed")
+
+def socket_rate_limited(budget: str):
+    """Drop a socket event once the sender's budget is spent, before the handler touches the DB"""
+    def decorator(handler):
+        @functools.wraps(handler)
+        async def wrapper(sid, *args):
+            session = await sio.get_session(sid)
+            retry_after = await rate_limiter.check(budget, session.get("user_id", sid))
+            if retry_after:
+                return {"error": "rate_limited", "retry_after": retry_after}
+            return await handler(sid, *args)
+        return wrapper
+    return decorator
+
 @sio.event
-async def connect(sid, environ):
-    print(f"Client {sid} connected")
+async def connect(sid, environ, auth=None):
+    """Authenticate the handshake JWT and join the user's personal and feed rooms"""
+    token = (auth or {}).get('token')
+    if not token:
+        raise socketio.exceptions.ConnectionRefusedError("Authentication required")
+    try:
+        payload = decode_jwt_token(token)
+    except HTTPException as e:
+        raise socketio.exceptions.ConnectionRefusedError(e.detail)
+    
+    user = await db.users.find_one({"id": payload.get("user_id")}, {"id": 1, "role": 1, "location": 1})
+    if not user:
+        raise socketio.exceptions.ConnectionRefusedError("User not found")
+    
+    await sio.save_session(sid, {"user_id": user["id"], "role": user["role"]})
+    await sio.enter_room(sid, get_user_room(user["id"]))
+    await sio.enter_room(sid, get_feed_room(user.get("location", "")))
+    await touch_presence(sid, user["id"])
+    print(f"Client {sid} connected as {user['id']}")
 
 @sio.event
 async def disconnect(sid):
+    user_id = presence.remove(sid)
+    if user_id and not presence.is_online(user_id):
+        await emit_presence(user_id, False)
     print(f"Client {sid} disconnected")
 
 @sio.event
+@socket_rate_limited("socket_events")
+async def heartbeat(sid, data=None):
+    """Keep the session's presence alive, clients send this every PRESENCE_TIMEOUT / 3 seconds"""
+    session = await sio.get_session(sid)
+    await touch_presence(sid, session["user_id"])
+
+@sio.event
+@socket_rate_limited("socket_rooms")
+async def watch_presence(sid, data):
+    """Subscribe to online/offline events for users and return their current status"""
+    user_ids = (data or {}).get('user_ids') or []
+    for user_id in user_ids:
+        await sio.enter_room(sid, get_presence_room(user_id))
+    return {user_id: presence.is_online(user_id) for user_id in user_ids}
+
+@sio.event
+@socket_rate_limited("socket_events")
+async def typing(sid, data):
+    """Relay a typing indicator to the other participant's sessions"""
+    session = await sio.get_session(sid)
+    receiver_id = (data or {}).get('receiver_id')
+    if receiver_id:
+        await sio.emit('typing', {
+            "user_id": session["user_id"],
+            "is_typing": bool(data.get('is_typing', True))
+        }, room=get_user_room(receiver_id))
+
+@sio.event
+@socket_rate_limited("socket_rooms")
 async def join_room(sid, data):
     room = data.get('room')
-    if room:
-        await sio.enter_room(sid, room)
\ No newline at end of file
+    # Personal rooms carry private messages and are only joined on connect
+    if room and not room.startswith(("user:", PRESENCE_SYNC_ROOM)):
+        await sio.enter_room(sid, room)
+
+@sio.event
+@socket_rate_limited("socket_rooms")
+async def join_feed(sid, data):
+    """Subscribe to new-post events for a location's feed"""
+    location = data.get('location')
+    if location:
+        await sio.enter_room(sid, get_feed_room(location))
+
+@sio.event
+@socket_rate_limited("socket_events")
+async def message_ack(sid, data):
+    """Mark pushed messages as delivered once the receiver's client has them"""
+    session = await sio.get_session(sid)
+    message_ids = data.get('message_ids') or []
+    if not message_ids:
+        return {"acknowledged": 0}
+    
+    if MESSAGE_STORAGE == "bucket":
+        acknowledged = await update_bucket_messages(
+            {"participants": session["user_id"]},
+            {"id": {"$in": message_ids}, "sender_id": {"$ne": session["user_id"]}, "delivered": {"$ne": True}},
+            {"delivered": True}
+        )
+        return {"acknowledged": acknowledged}
+    
+    result = await db.messages.update_many(
+        {"id": {"$in": message_ids}, "receiver_id": session["user_id"], "delivered": {"$ne": True}},
+        {"$set": {"delivered": True}}
+    )
+    return {"acknowledged": result.modified_count}
+
+@sio.event
+@socket_rate_limited("socket_events")
+async def resume_messages(sid, data):
+    """Return messages received after the client's last seen message id.
+    
+    Without a last seen id, returns the messages never acked as delivered.
+    """
+    session = await sio.get_session(sid)
+    if MESSAGE_STORAGE == "bucket":
+        messages = await resume_bucket_messages(session["user_id"], (data or {}).get('last_seen_id'))
+        return {
+            "messages": jsonable_encoder([Message(**msg) for msg in messages[:MESSAGE_RESUME_LIMIT]]),
+            "has_more": len(messages) > MESSAGE_RESUME_LIMIT
+        }
+    
+    query = {"receiver_id": session["user_id"]}
+    
+    last_seen_id = (data or {}).get('last_seen_id')
+    last_seen = None
+    if last_seen_id:
+        last_seen = await db.messages.find_one(
+            {"id": last_seen_id}, {"id": 1, "created_at": 1, "sender_id": 1, "receiver_id": 1}
+        )
+        if last_seen and session["user_id"] not in (last_seen["sender_id"], last_seen["receiver_id"]):
+            last_seen = None
+    if last_seen:
+        # Same (created_at, id) order as conversations, so messages sharing the timestamp aren't dropped
+        query["$or"] = [
+            {"created_at": {"$gt": last_seen["created_at"]}},
+            {"created_at": last_seen["created_at"], "id": {"$gt": last_seen["id"]}}
+        ]
+    else:
+        query["delivered"] = {"$ne": True}
+    
+    messages = await db.messages.find(query).sort(
+        [("created_at", 1), ("id", 1)]
+    ).limit(MESSAGE_RESUME_LIMIT + 1).to_list(MESSAGE_RESUME_LIMIT + 1)
+    return {
+        "messages": jsonable_encoder([Message(**msg) for msg in messages[:MESSAGE_RESUME_LIMIT]]),
+        "has_more": len(messages) > MESSAGE_RESUME_LIMIT
+    }
@@ -0,0 +1,74 @@
+"""Socket.IO fan-out benchmark.
+
+Simulates connected clients spread over several Socket.IO servers ("workers")
+sharing rooms through a client manager, emits events to a room from one worker
+and measures how fast they are delivered to every client.
+
+Usage:
+    python socketio_benchmark.py --clients 10000 --workers 4 --events 50
+"""
+import argparse
+import asyncio
+import time
+import uuid
+
+import socketio
+
+from server import LocalPubSubManager
+
+
+async def run_benchmark(clients: int, workers: int, events: int, room: str):
+    channel = f"benchmark-{uuid.uuid4().hex}"
+    servers = []
+    delivered = 0
+    all_delivered = asyncio.Event()
+    expected = clients * events
+
+    async def count_packet(eio_sid, pkt):
+        nonlocal delivered
+        delivered += 1
+        if delivered >= expected:
+            all_delivered.set()
+
+    for _ in range(workers):
+        manager = LocalPubSubManager(channel=channel) if workers > 1 else None
+        server = socketio.AsyncServer(client_manager=manager)
+        server._send_eio_packet = count_packet  # no real transports, just count deliveries
+        server.manager.initialize()
+        servers.append(server)
+
+    # Connect clients round-robin across workers and join them to the room
+    for i in range(clients):
+        server = servers[i % workers]
+        sid = await server.manager.connect(f"eio-{i}", "/")
+        server.manager.basic_enter_room(sid, "/", room)
+
+    start = time.perf_counter()
+    for i in range(events):
+        await servers[0].emit("new_posts", {"posts": [{"id": str(i)}]}, room=room)
+    await asyncio.wait_for(all_delivered.wait(), timeout=300)
+    elapsed = time.perf_counter() - start
+
+    for server in servers:
+        if getattr(server.manager, "thread", None):
+            server.manager.thread.cancel()
+
+    print(f"clients={clients} workers={workers} events={events}")
+    print(f"  deliveries:  {delivered}")
+    print(f"  elapsed:     {elapsed:.3f}s")
+    print(f"  per event:   {elapsed / events * 1000:.2f}ms")
+    print(f"  throughput:  {delivered / elapsed:,.0f} deliveries/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Socket.IO fan-out benchmark")
+    parser.add_argument("--clients", type=int, default=10000)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--events", type=int, default=50)
+    parser.add_argument("--room", default="feed:benchmark")
+    args = parser.parse_args()
+    asyncio.run(run_benchmark(args.clients, args.workers, args.events, args.room))
+
+
+if __name__ == "__main__":
+    main()
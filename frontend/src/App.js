@@ -108,7 +108,7 @@ function AuthProvider({ children }) {
     setUser(userData);
     
     // Initialize socket
-    socket = io(BACKEND_URL);
+    socket = io(BACKEND_URL, { auth: { token: newToken } });
     
     return response.data;
   };
@@ -122,7 +122,7 @@ function AuthProvider({ children }) {
     setUser(newUser);
     
     // Initialize socket
-    socket = io(BACKEND_URL);
+    socket = io(BACKEND_URL, { auth: { token: newToken } });
     
     return response.data;
   };